@@ -7,8 +7,11 @@ import threading
 # from models.keras_vae import train_vae
 # from models.keras_cvae import train_cvae
 import time
-from models.pytorch_cvae import train_torch_cvae, load_model_and_dataset, load_model_and_dataset_retrain, generate_samples
-from utils.dataset_utils import TabularDataset, save_dataset, load_dataset
+from models.pytorch_cvae import train_torch_cvae, load_model_and_dataset, load_model_and_dataset_retrain, generate_samples, \
+    generate_sample_chunks, generate_group_aggregates, generate_replicate_samples
+from utils.dataset_utils import TabularDataset, save_dataset, load_origin_data
+from utils.execution_context import ExecutionContext
+from utils.replicate_executor import process_replicates_supported, run_process_replicates, share_model_dataset
 import pandas as pd
 import numpy as np
 from utils.plot_utils import plot
@@ -80,8 +83,7 @@ def generate_sample_list(model_dataset_list, query_config, train_config_list):
         if train_config_list[i]['operation'] == 'aqp':
             sample = generate_samples(model, dataset, query_config, train_config_list[i])
         else:
-            full_dataset = load_dataset(train_config_list[i])
-            sample = full_dataset.origin_df
+            sample = load_origin_data(train_config_list[i])
             sample['{}_rate'.format(dataset.name)] = 1.0
         # if train_config_list[i]['name'].endswith('store'):
         #     print(sample)
@@ -389,6 +391,121 @@ def sample_aggregation(sample_list, query_config, train_config_list):
         del agg_result[rate_col]
     return agg_result
 
+
+def streaming_aggregation_enabled(model_dataset_list, query_config, train_config_list):
+    # group by queries on one generated table, or on a generated table joined with one other table
+    if 'streaming_aggregation' not in query_config or query_config['streaming_aggregation'] != 'true':
+        return False
+    if 'outliers' in train_config_list[0] and train_config_list[0]['outliers'] == 'true':
+        return False
+    if len(query_config['groupby_cols']) == 0 or len(train_config_list) > 2:
+        return False
+    if any(train_config['operation'] != 'aqp' for train_config in train_config_list):
+        return False
+    # the group by columns have to come from the streamed table
+    _, dataset = model_dataset_list[0]
+    streamed_cols = dataset.categorical_columns + dataset.numeric_columns + [dataset.label_column_name]
+    return all(col in streamed_cols for col in query_config['groupby_cols'])
+
+
+def streaming_sample_aggregation(model_dataset_list, query_config, train_config_list):
+    # fold the generated chunks of the first table into per group partial sums, instead of
+    # materializing the samples; the result has the same format as sample_aggregation
+    sum_cols = query_config['sum_cols']
+    avg_cols = query_config['avg_cols']
+    join_cols = query_config['join_cols']
+    groupby_cols = query_config['groupby_cols']
+    agg_cols = list(dict.fromkeys(avg_cols + sum_cols))
+    model, dataset = model_dataset_list[0]
+    rate_col = '{}_rate'.format(dataset.name)
+
+    join_agg = None
+    if len(train_config_list) > 1:
+        # the other side is materialized once and reduced to count, weight and column sums per join key
+        join_model, join_dataset = model_dataset_list[1]
+        join_samples = generate_samples(join_model, join_dataset, query_config, train_config_list[1])
+        join_weight = 1.0 / join_samples['{}_rate'.format(join_dataset.name)]
+        aggregations = {'cnt': (join_cols[1], 'size'), 'weight': ('weight', 'sum')}
+        join_samples['weight'] = join_weight
+        for col in agg_cols:
+            if col in join_samples.columns:
+                join_samples['scale_' + col] = join_samples[col] * join_weight
+                aggregations[col] = (col, 'sum')
+                aggregations['scale_' + col] = ('scale_' + col, 'sum')
+        join_agg = join_samples.groupby(by=join_cols[1]).agg(**aggregations)
+
+    partial_agg = None
+    for chunk in generate_sample_chunks(model, dataset, query_config, train_config_list[0]):
+        folds = chunk[groupby_cols].copy()
+        if join_agg is None:
+            folds['cnt'] = 1
+            folds['rate'] = chunk[rate_col].values
+            for col in agg_cols:
+                folds[col] = chunk[col].values.astype(np.float64)
+        else:
+            # every row stands for all the rows of the other side with the same join key
+            matched = join_agg.reindex(chunk[join_cols[0]].values).fillna(0)
+            cnt = matched['cnt'].values
+            inv_rate = 1.0 / chunk[rate_col].values
+            folds['cnt'] = cnt
+            for col in agg_cols:
+                if col in chunk.columns:
+                    values = chunk[col].values.astype(np.float64)
+                    folds['avg_' + col] = values * cnt
+                    folds['sum_' + col] = values * inv_rate * matched['weight'].values
+                else:
+                    folds['avg_' + col] = matched[col].values
+                    folds['sum_' + col] = inv_rate * matched['scale_' + col].values
+        chunk_agg = folds.groupby(by=groupby_cols).sum()
+        partial_agg = chunk_agg if partial_agg is None else partial_agg.add(chunk_agg, fill_value=0)
+
+    if join_agg is not None:
+        # groups without any joined row do not appear in an inner join
+        partial_agg = partial_agg[partial_agg['cnt'] > 0]
+    agg_result = pd.DataFrame(index=partial_agg.index)
+    if join_agg is None:
+        for col in avg_cols:
+            agg_result["avg({})".format(col)] = partial_agg[col] / partial_agg['cnt']
+        for col in sum_cols:
+            agg_result["sum({})".format(col)] = partial_agg[col] / (partial_agg['rate'] / partial_agg['cnt'])
+    else:
+        for col in avg_cols:
+            agg_result["avg({})".format(col)] = partial_agg['avg_' + col] / partial_agg['cnt']
+        for col in sum_cols:
+            agg_result["sum({})".format(col)] = partial_agg['sum_' + col]
+    return agg_result
+
+
+def direct_aggregation_enabled(model_dataset_list, query_config, train_config_list):
+    # single table group by on the label column, the group of every generated row is its allocated label
+    if 'direct_aggregation' not in query_config or query_config['direct_aggregation'] != 'true':
+        return False
+    if len(train_config_list) > 1 or train_config_list[0]['operation'] != 'aqp':
+        return False
+    if 'outliers' in train_config_list[0] and train_config_list[0]['outliers'] == 'true':
+        return False
+    _, dataset = model_dataset_list[0]
+    if query_config['groupby_cols'] != [dataset.label_column_name]:
+        return False
+    return all(col in dataset.numeric_columns for col in query_config['avg_cols'] + query_config['sum_cols'])
+
+
+def direct_sample_aggregation(model_dataset_list, query_config, train_config_list):
+    # same result format as sample_aggregation, without building the samples DataFrame
+    sum_cols = query_config['sum_cols']
+    avg_cols = query_config['avg_cols']
+    groupby_cols = query_config['groupby_cols']
+    model, dataset = model_dataset_list[0]
+    label_values, counts, sums, rates = generate_group_aggregates(model, dataset, query_config, train_config_list[0])
+    sums = pd.DataFrame(sums, index=pd.Index(label_values, name=groupby_cols[0]), columns=dataset.numeric_columns)
+    agg_result = pd.DataFrame(index=sums.index)
+    for col in avg_cols:
+        agg_result["avg({})".format(col)] = sums[col] / counts
+    for col in sum_cols:
+        agg_result["sum({})".format(col)] = sums[col] / rates
+    return agg_result.sort_index()
+
+
 def sample_aggregation_prev(sample_list, query_config, train_config_list):
     sum_cols = query_config['sum_cols']
     avg_cols = query_config['avg_cols']
@@ -500,17 +617,55 @@ def sample_list_combination(sample_list_list):
     return sample_list_comb
 
 
-def sample_generation_and_aggregation(model_dataset_list, query_config, train_config_list, sample_agg_list):
-    start_time = time.perf_counter()
+def replicate_batching_enabled(query_config, train_config_list):
+    # group by queries on generated tables with more than one replicate
+    if 'replicate_batching' not in query_config or query_config['replicate_batching'] != 'true':
+        return False
+    if query_config['multi_sample_times'] <= 1 or len(query_config['groupby_cols']) == 0:
+        return False
+    return all(train_config['operation'] == 'aqp' for train_config in train_config_list)
+
+
+def replicate_batched_aggregation(model_dataset_list, query_config, train_config_list):
+    # generate all replicates of every table in one pass and aggregate them with replicate_id as an extra key,
+    # a replicate only joins rows of the same replicate
+    replicates = query_config['multi_sample_times']
+    replicate_query_config = dict(query_config)
+    replicate_query_config['join_cols'] = [[col, 'replicate_id'] for col in query_config['join_cols']]
+    replicate_query_config['groupby_cols'] = query_config['groupby_cols'] + ['replicate_id']
+    sample_list = []
+    for i in range(len(train_config_list)):
+        model, dataset = model_dataset_list[i]
+        sample_list.append(generate_replicate_samples(model, dataset, query_config, train_config_list[i], replicates))
+    return sample_aggregation(sample_list, replicate_query_config, train_config_list)
+
+
+def generate_and_aggregate(model_dataset_list, query_config, train_config_list):
+    if direct_aggregation_enabled(model_dataset_list, query_config, train_config_list):
+        return direct_sample_aggregation(model_dataset_list, query_config, train_config_list)
+    if streaming_aggregation_enabled(model_dataset_list, query_config, train_config_list):
+        return streaming_sample_aggregation(model_dataset_list, query_config, train_config_list)
     sample_list = generate_sample_list(model_dataset_list, query_config, train_config_list)
     # logger.info('===================:{}'.format(time.perf_counter() - start_time))
-    sample_agg = sample_aggregation(sample_list, query_config, train_config_list)
+    return sample_aggregation(sample_list, query_config, train_config_list)
+
+
+def sample_generation_and_aggregation(model_dataset_list, query_config, train_config_list, sample_agg_list,
+                                      execution_context=None, replicate_id=0):
+    start_time = time.perf_counter()
+    if execution_context is not None:
+        execution_context.pin_replicate(replicate_id)
+    sample_agg = generate_and_aggregate(model_dataset_list, query_config, train_config_list)
     sample_agg_list.append(sample_agg)
     end_time = time.perf_counter()
     logger.info('sample and aggregation time elapsed:{}'.format(end_time - start_time))
 
-def model_aqp(query_config, train_config_list):
+def model_aqp(query_config, train_config_list, execution_context=None):
     # train models
+    if execution_context is None:
+        execution_context = ExecutionContext(query_config)
+    # library callers (and prompt.py) reach model_aqp without the __main__ setup, apply only runs once per context
+    execution_context.apply()
 
     # if train_flag == 'train':
     #     model_dataset_list = train_models(train_config_list)
@@ -522,21 +677,40 @@ def model_aqp(query_config, train_config_list):
     sample_agg_list = []
     threads = []
     start_time = time.perf_counter()
-    for i in range(multi_sample_times):
-        logger.info("multi_sampling No.{} epoch".format(i))
-        # sample_list = generate_sample_list(model_dataset_list, query_config, train_config_list)
-        # sample_agg = sample_aggregation(sample_list, query_config, train_config_list)
-        # sample_agg_list.append(sample_agg)
-
-        # sample_generation_and_aggregation(model_dataset_list, query_config, train_config_list, sample_agg_list)
-
-        thread = threading.Thread(target=sample_generation_and_aggregation,
-                                  args=(model_dataset_list, query_config, train_config_list, sample_agg_list))
-        threads.append(thread)
-        thread.start()
-
-    for t in threads:
-        t.join()
+    process_flag = execution_context.replicate_executor == 'process' and multi_sample_times > 1 and \
+                   process_replicates_supported(model_dataset_list)
+    if replicate_batching_enabled(query_config, train_config_list):
+        # all replicates come out of one generation pass, split again by replicate_id after the aggregation
+        logger.info("multi_sampling {} replicates in one batch".format(multi_sample_times))
+        replicate_agg = replicate_batched_aggregation(model_dataset_list, query_config, train_config_list)
+        sample_agg_list = [agg.droplevel('replicate_id') for _, agg in replicate_agg.groupby(level='replicate_id')]
+    else:
+        with execution_context.replicates_scope():
+            if process_flag:
+                # the replicates run in forked processes and only send back their aggregation results
+                logger.info("multi_sampling {} replicates in processes".format(multi_sample_times))
+                for model, dataset in model_dataset_list:
+                    share_model_dataset(model, dataset)
+                sample_agg_list = run_process_replicates(generate_and_aggregate,
+                                                         (model_dataset_list, query_config, train_config_list),
+                                                         multi_sample_times, execution_context)
+            else:
+                for i in range(multi_sample_times):
+                    logger.info("multi_sampling No.{} epoch".format(i))
+                    # sample_list = generate_sample_list(model_dataset_list, query_config, train_config_list)
+                    # sample_agg = sample_aggregation(sample_list, query_config, train_config_list)
+                    # sample_agg_list.append(sample_agg)
+
+                    # sample_generation_and_aggregation(model_dataset_list, query_config, train_config_list, sample_agg_list)
+
+                    thread = threading.Thread(target=sample_generation_and_aggregation,
+                                              args=(model_dataset_list, query_config, train_config_list, sample_agg_list,
+                                                    execution_context, i))
+                    threads.append(thread)
+                    thread.start()
+
+                for t in threads:
+                    t.join()
     sample_agg = pd.concat(sample_agg_list).groupby(level=0).mean()
 
     end_time = time.perf_counter()
@@ -588,6 +762,8 @@ if __name__ == '__main__':
             train_config_list.append(train_config)
             logger.info("load train config {} successfully".format(config_file))
 
+    execution_context = ExecutionContext(query_config)
+    execution_context.apply()
     op = query_config['operation']
     if op == 'origin':
         # ground truth
@@ -597,6 +773,6 @@ if __name__ == '__main__':
         uniform_aqp(query_config, train_config_list)
     else:
         ## model aqp
-        model_aqp(query_config, train_config_list)
+        model_aqp(query_config, train_config_list, execution_context)
         end_time = time.perf_counter()
         logger.info("total_time:{}".format(end_time - start_time))
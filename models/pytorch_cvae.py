@@ -5,16 +5,17 @@ import numpy as np
 import pandas as pd
 import threading
 import torch
-from keras.utils.np_utils import to_categorical
 import torch.nn.functional as F
 from torch import nn
 from torch.nn import Linear, Module, Parameter, ReLU, Sequential
-from torch.utils.data import DataLoader
+from torch.utils.data import BatchSampler, DataLoader, SequentialSampler
 from torch import optim
-from utils.model_utils import save_torch_model, load_torch_model
+from utils.model_utils import save_torch_model, load_torch_model, save_traced_decoder, load_traced_decoder, \
+    get_weights_digest
 import logging
 from utils.dataset_utils import *
 from utils.pytorchtools import EarlyStopping
+from utils.sample_writer import spool_samples
 
 logger = logging.getLogger(__name__)
 
@@ -57,6 +58,14 @@ class CVAE(nn.Module):
         self.output_info = dataset.encoded_output_info
 
         self.sigmoid = nn.Sigmoid()
+        # per-thread input buffers reused by generate_with_bias, not pickled or copied with the model
+        self.generation_buffers = threading.local()
+        # label part of the first decoder layer for every label code, see get_label_bias
+        self.label_bias = None
+        self.label_bias_source = None
+        # traced or quantized BiasDecoder used by generate_with_bias once it is loaded, see export_traced_decoder
+        # and quantize_decoder, it is set with set_serving_decoder so that it is not a submodule of the CVAE
+        self.serving_decoder = None
 
         # self.output_layers = nn.ModuleList(
         #     [nn.Linear(intermediate_dim, digit) for digit, activ in dataset.encoded_output_info])
@@ -93,6 +102,62 @@ class CVAE(nn.Module):
         # sigma = Parameter(torch.ones(self.origin_dim) * 0.1)
         return output
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['generation_buffers'] = None
+        state['serving_decoder'] = None
+        return state
+
+    def __setstate__(self, state):
+        super(CVAE, self).__setstate__(state)
+        self.generation_buffers = threading.local()
+
+    def set_serving_decoder(self, decoder):
+        # kept out of _modules, so state_dict, to() and share_memory() only see the CVAE weights
+        object.__setattr__(self, 'serving_decoder', decoder)
+
+    def get_generation_inputs(self, n, device, name='inputs', dim=None):
+        buffers = self.generation_buffers
+        inputs = getattr(buffers, name, None)
+        if inputs is None or inputs.size(0) < n or inputs.device != device:
+            inputs = torch.empty(n, self.latent_dim + self.label_dim if dim is None else dim, device=device)
+            setattr(buffers, name, inputs)
+        return inputs[:n]
+
+    def get_label_bias(self, label_cache):
+        """
+        label_cache: condition row of every label code
+        return: W_c·c + b of the first decoder layer for every label code, computed once per label cache
+        """
+        if self.label_bias is None or self.label_bias_source is not label_cache:
+            first_layer = self.decode_seq[0]
+            with torch.no_grad():
+                self.label_bias = F.linear(label_cache, first_layer.weight[:, self.latent_dim:], first_layer.bias)
+            self.label_bias_source = label_cache
+        return self.label_bias
+
+    def generate_with_bias(self, label_bias, n, activate=True):
+        """
+        grad-free generation entry point
+        label_bias: rows of get_label_bias for the n samples, or a single row shared by all of them
+        n: number of samples
+        activate: apply the output activations, otherwise return the raw logits
+        return: decoder output of shape (n, data_dim), same as decode with the matching conditions
+        """
+        with torch.no_grad():
+            z = self.get_generation_inputs(n, label_bias.device, 'latent', self.latent_dim).normal_()
+            if self.serving_decoder is not None:
+                if activate:
+                    return self.serving_decoder.activated(z, label_bias.expand(n, -1))
+                return self.serving_decoder(z, label_bias.expand(n, -1))
+            # only the latent part of the first decoder layer is left per sample
+            first_layer = self.decode_seq[0]
+            h = torch.addmm(label_bias.expand(n, -1), z, first_layer.weight[:, :self.latent_dim].t())
+            fake = self.fc4(self.decode_seq[1:](h))
+            if activate:
+                fake = activate_output_(fake, self.output_info)
+            return fake
+
     def forward(self, x, c):
         mu, logvar = self.encode(x, c)  # 编码
         z = self.reparametrize(mu, logvar)  # 重新参数化成正态分布
@@ -141,10 +206,15 @@ def alpha_schedule(epoch, max_epoch, alpha_max, strategy="exp"):
 
 def torch_cvae_train(model, dataset, epochs, batch_size):
     start_time = time.perf_counter()
-    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, drop_last=False)
+    # the dataset is indexed by whole mini-batches, its one-hot data is densified batch by batch
+    loader = DataLoader(dataset, sampler=BatchSampler(SequentialSampler(dataset), batch_size, drop_last=False),
+                        batch_size=None)
     optimizer = optim.Adam(model.parameters(), weight_decay=1e-5)
     # optimizer = optim.Adam(model.parameters(),lr=1e-3)
     early_stopping = EarlyStopping(patience=10, verbose=True)
+    # the cached label bias and the serving decoder are stale once the weights change
+    model.label_bias = None
+    model.set_serving_decoder(None)
     latent_param = {}
     for epoch in range(epochs):
         epoch_start_time = time.perf_counter()
@@ -186,7 +256,7 @@ def torch_cvae_train(model, dataset, epochs, batch_size):
     return model
 
 
-def generate_samples(model, dataset, query_config, train_config):
+def get_sample_allocation(model, dataset, query_config, train_config):
     sample_rate = train_config["sample_rate"]
     if train_config['sample_method'] == "senate":
         sample_allocation, sample_rates = senate_sampling(model, dataset, sample_rate)
@@ -220,19 +290,59 @@ def generate_samples(model, dataset, query_config, train_config):
         elif '>' in condition:
             bound_value = int(condition.split('>')[-1])
             sample_allocation = {k: v for k, v in sample_allocation.items() if k > bound_value}
+    return sample_allocation, sample_rates
+
 
+def generate_samples(model, dataset, query_config, train_config):
+    sample_allocation, sample_rates = get_sample_allocation(model, dataset, query_config, train_config)
     samples = generate_samples_with_allocation(dataset, model, sample_allocation, sample_rates, train_config)
     # print("sample_allocation: ", sample_allocation)
     # print("sample_rates: ", sample_rates)
     # print(samples[:10])
-    samples.to_csv('./output/'+train_config['name']+".csv",index=False)
+    save_flag = 'save_samples' in train_config and train_config['save_samples'] == 'true'
+    if save_flag:
+        spool_samples(samples, train_config['name'])
     if 'outliers' in train_config and train_config['outliers'] == 'true':
         samples = pd.concat([samples, dataset.outliers])
-        samples.to_csv('./output/'+train_config['name']+"_with_outlier.csv",index=False)
+        if save_flag:
+            spool_samples(samples, train_config['name'] + "_with_outlier")
     # save_samples(samples, train_config)
     # samples=read_samples(train_config)
     return samples
 
+
+def generate_replicate_samples(model, dataset, query_config, train_config, replicates):
+    # the samples of several replicates in one generation pass, told apart by the replicate_id column
+    sample_allocation, sample_rates = get_sample_allocation(model, dataset, query_config, train_config)
+    replicate_allocation = {k: int(v) * replicates for k, v in sample_allocation.items()}
+    samples = generate_samples_with_allocation(dataset, model, replicate_allocation, sample_rates, train_config)
+    # every label group is one segment of replicates * count rows, split into consecutive replicates
+    _, label_counts = get_allocation_label_counts(dataset, sample_allocation)
+    segment_sizes = label_counts * replicates
+    segment_starts = np.cumsum(segment_sizes) - segment_sizes
+    positions = np.arange(len(samples)) - np.repeat(segment_starts, segment_sizes)
+    samples['replicate_id'] = positions // np.repeat(label_counts, segment_sizes)
+    save_flag = 'save_samples' in train_config and train_config['save_samples'] == 'true'
+    if save_flag:
+        spool_samples(samples, train_config['name'])
+    if 'outliers' in train_config and train_config['outliers'] == 'true':
+        outliers = [dataset.outliers.assign(replicate_id=replicate_id) for replicate_id in range(replicates)]
+        samples = pd.concat([samples] + outliers)
+        if save_flag:
+            spool_samples(samples, train_config['name'] + "_with_outlier")
+    return samples
+
+
+def generate_sample_chunks(model, dataset, query_config, train_config):
+    # same samples as generate_samples, yielded as decoded DataFrame chunks and never materialized as a whole
+    sample_allocation, sample_rates = get_sample_allocation(model, dataset, query_config, train_config)
+    for codes, values in compact_sample_chunks(dataset, model, sample_allocation, train_config):
+        chunk_df = dataset.decode_compact_samples(codes.cpu().numpy(), values.cpu().numpy())
+        chunk_df = generate_label_column(chunk_df, list(train_config['label_columns']),
+                                         list(train_config['bucket_columns']), dataset.label_column_name)
+        chunk_df['{}_rate'.format(dataset.name)] = chunk_df[dataset.label_column_name].map(sample_rates)
+        yield chunk_df
+
 def train_torch_cvae(train_config):
     # hyper parameters
     start_time = time.perf_counter()
@@ -252,7 +362,7 @@ def train_torch_cvae(train_config):
     else:
         dataset = TabularDataset(train_config)
     logger.info("feature info:{}".format(dataset.feature_info))
-    _, data_dim = dataset.data.shape
+    data_dim = dataset.data_dim
     model = CVAE(data_dim, dataset.label_size, intermediate_dim, latent_dim, dataset)
     # if torch.cuda.device_count() > 1:
     #     model = nn.DataParallel(model, device_ids=[0, 1, 2, 3])
@@ -260,6 +370,9 @@ def train_torch_cvae(train_config):
     model = torch_cvae_train(model, dataset, epochs=epochs, batch_size=batch_size)
     save_torch_model(model, train_config)
     save_dataset(dataset, train_config)
+    dataset.build_label_cache()
+    if 'trace_decoder' in train_config and train_config['trace_decoder'] == 'true':
+        export_traced_decoder(model, dataset, train_config)
     end_time = time.perf_counter()
     logger.info("train model time elapsed:{}".format(end_time - start_time))
     return model, dataset
@@ -282,6 +395,13 @@ def load_model_and_dataset(train_config):
     # model.to(dataset.device)
     if model is None:
         logger.error("model file not found")
+    dataset.build_label_cache()
+    if model is not None:
+        if 'quantized' in train_config and train_config['quantized'] == 'true':
+            model.set_serving_decoder(quantize_decoder(model))
+        else:
+            # generation goes through the traced decoder when one was exported with the model
+            model.set_serving_decoder(load_traced_decoder(train_config, get_weights_digest(model), postfix=postfix))
     end_time = time.perf_counter()
     logger.info("load model time elapsed:{}".format(end_time - start_time))
     return model, dataset
@@ -313,78 +433,180 @@ def load_model_and_dataset_retrain(train_config):
         postfix = train_config['inc_train_flag']
     save_torch_model(model, train_config, postfix=postfix)
     save_dataset(dataset, train_config, postfix=postfix)
+    dataset.build_label_cache()
+    if 'trace_decoder' in train_config and train_config['trace_decoder'] == 'true':
+        # a decoder exported before the retraining no longer matches the weights
+        export_traced_decoder(model, dataset, train_config, postfix=postfix)
     return model, dataset
 
-def generate_group_samples(sample_count, label, latent_dim, batch_size, model, z_decoded_list):
-    start_time = time.perf_counter()
+class BiasDecoder(nn.Module):
+    """Decoder from latent noise and label bias rows, the part of CVAE that is traced or quantized."""
+    def __init__(self, model):
+        super(BiasDecoder, self).__init__()
+        first_layer = model.decode_seq[0]
+        # latent columns of the first decoder layer, its label columns and bias are in the label bias rows
+        self.latent_layer = Linear(model.latent_dim, model.intermediate_dim, bias=False).to(first_layer.weight.device)
+        with torch.no_grad():
+            self.latent_layer.weight.copy_(first_layer.weight[:, :model.latent_dim])
+        self.decode_seq = model.decode_seq[1:]
+        self.fc4 = model.fc4
+        self.output_info = model.output_info
+
+    def forward(self, z, label_bias):
+        return self.fc4(self.decode_seq(self.latent_layer(z) + label_bias))
+
+    def activated(self, z, label_bias):
+        return activate_output_(self.forward(z, label_bias), self.output_info)
+
+
+def export_traced_decoder(model, dataset, train_config, postfix=''):
+    # trace the decoder with the output activations and check it against the eager CVAE.decode before saving
+    model.eval()
+    label_cache = dataset.label_cache
+    codes = torch.arange(train_config['batch_size'], device=label_cache.device) % label_cache.size(0)
+    with torch.no_grad():
+        z = torch.randn(len(codes), model.latent_dim, device=label_cache.device)
+        label_bias = model.get_label_bias(label_cache).index_select(0, codes)
+        decoder = BiasDecoder(model)
+        # raw logits feed the compact decoding, the activated output serves generate_with_bias(activate=True)
+        traced_decoder = torch.jit.trace_module(decoder, {'forward': (z, label_bias), 'activated': (z, label_bias)})
+        expected = model.decode(z, label_cache.index_select(0, codes))
+        max_diff = (traced_decoder(z, label_bias) - expected).abs().max().item()
+        expected = activate_output_(expected, model.output_info)
+        max_diff = max(max_diff, (traced_decoder.activated(z, label_bias) - expected).abs().max().item())
+    if max_diff > 1e-4:
+        logger.error("traced decoder differs from the eager decoder by {}, not exported".format(max_diff))
+        return None
+    save_traced_decoder(traced_decoder, train_config, get_weights_digest(model), postfix=postfix)
+    return traced_decoder
+
+
+def quantize_decoder(model):
+    # dynamic int8 quantization of the Linear layers of the decoder, the label bias rows stay in float
+    if model.device.type != 'cpu':
+        logger.warning("dynamic quantization only runs on cpu, keep the float decoder on {}".format(model.device))
+        return None
+    model.eval()
+    decoder = torch.quantization.quantize_dynamic(BiasDecoder(model), {nn.Linear}, dtype=torch.qint8)
+    logger.info("quantized decoder:{}".format(decoder))
+    return decoder
+
+
+def activate_output_(fake, output_info):
+    # apply the output activations in place on the column slices of fake
+    st = 0
+    for digit, activ in output_info:
+        ed = st + digit
+        if activ == 'tanh':
+            fake[:, st:ed].tanh_()
+        elif activ == 'softmax':
+            fake[:, st:ed] = torch.softmax(fake[:, st:ed], dim=1)
+        elif activ == 'sigmoid':
+            fake[:, st:ed].sigmoid_()
+        st = ed
+    return fake
+
+
+def group_label_chunks(label, sample_count, batch_size):
+    # conditions of one label group in chunks of at most batch_size rows
     while sample_count > 0:
         each_step_samples = sample_count if sample_count < batch_size else batch_size
-        each_label = label[:each_step_samples, ]
         sample_count -= batch_size
-        ### 0-1 normal
-        mean = torch.zeros(each_step_samples, latent_dim).to(model.device)
-        std = mean + 1
+        yield label[:each_step_samples, ]
 
-        ### param normal
-        noise = torch.normal(mean=mean, std=std).to(model.device)
-        fake = model.decode(noise, each_label)
 
-        ### activate output
-        column_list = []
-        st = 0
-        for digit, activ in model.output_info:
-            ed = st + digit
-            if activ == 'tanh':
-                column_list.append(torch.tanh(fake[:, st:ed]))
-            elif activ == 'softmax':
-                column_list.append(torch.softmax(fake[:, st:ed], dim=1))
-            elif activ == 'sigmoid':
-                column_list.append(torch.sigmoid(fake[:, st:ed]))
-            else:
-                column_list.append(fake[:, st:ed])
-                # column_list.append(torch.tanh(fake[:, st:ed]))
-            st = ed
-        fake = torch.cat(column_list, dim=1)
-        z_decoded = fake.detach().cpu().numpy()
-        z_decoded_list.append(z_decoded)
-    end_time = time.perf_counter()
-    # logger.info('generate group samples time:{}'.format(end_time - start_time))
+def fused_label_chunks(label_codes, label_counts, label_table, chunk_size):
+    # rows of all groups together in fixed-size chunks, gathered from the per label code table
+    # the code of every row is looked up per chunk, so no array of the whole allocation is built
+    ends = np.cumsum(label_counts)
+    total_samples = int(ends[-1]) if len(ends) > 0 else 0
+    for st in range(0, total_samples, chunk_size):
+        ed = min(st + chunk_size, total_samples)
+        chunk_codes = label_codes[np.searchsorted(ends, np.arange(st, ed), side='right')]
+        yield label_table.index_select(0, torch.from_numpy(chunk_codes).to(label_table.device))
+
+
+def get_allocation_label_counts(dataset, sample_allocation):
+    # label codes of the allocated groups and their sample counts
+    codes = []
+    counts = []
+    for label_value_idx, label_value in dataset.label_value_mapping.items():
+        if label_value in sample_allocation:
+            codes.append(label_value_idx)
+            counts.append(int(sample_allocation[label_value]))
+    counts = np.maximum(np.array(counts, dtype=np.int64), 0)
+    return np.array(codes, dtype=np.int64), counts
+
+
+def allocation_label_chunks(dataset, label_table, sample_allocation, train_config):
+    # rows of a per label code table (conditions or label biases) for the whole allocation, group by group
+    batch_size = train_config["batch_size"]
+    if 'generation_mode' in train_config and train_config['generation_mode'] == 'group':
+        for label_value_idx, label_value in dataset.label_value_mapping.items():
+            if label_value in sample_allocation:
+                sample_count = int(sample_allocation[label_value])
+                label = label_table[label_value_idx].expand(batch_size, -1)
+                for each_label in group_label_chunks(label, sample_count, batch_size):
+                    yield each_label
+    else:
+        chunk_size = train_config['generation_batch_size'] if 'generation_batch_size' in train_config else 65536
+        label_codes, label_counts = get_allocation_label_counts(dataset, sample_allocation)
+        for each_label in fused_label_chunks(label_codes, label_counts, label_table, chunk_size):
+            yield each_label
+
+
+def compact_sample_chunks(dataset, model, sample_allocation, train_config):
+    # raw logits decoded chunk by chunk into int32 category codes and float32 numeric values
+    label_bias = model.get_label_bias(dataset.label_cache)
+    for each_bias in allocation_label_chunks(dataset, label_bias, sample_allocation, train_config):
+        logits = model.generate_with_bias(each_bias, each_bias.size(0), activate=False)
+        yield dataset.decode_logits(logits)
+
+
+def generate_compact_samples(dataset, model, sample_allocation, train_config):
+    # all chunks of compact_sample_chunks in one array pair
+    _, label_counts = get_allocation_label_counts(dataset, sample_allocation)
+    total_samples = int(label_counts.sum())
+    # the total sample size is known up front, so every chunk is written into preallocated arrays
+    codes = np.empty((total_samples, len(dataset.categorical_columns)), dtype=np.int32)
+    values = np.empty((total_samples, len(dataset.numeric_columns)), dtype=np.float32)
+    st = 0
+    for chunk_codes, chunk_values in compact_sample_chunks(dataset, model, sample_allocation, train_config):
+        ed = st + chunk_codes.size(0)
+        torch.from_numpy(codes[st:ed]).copy_(chunk_codes)
+        torch.from_numpy(values[st:ed]).copy_(chunk_values)
+        st = ed
+    return codes, values
+
+
+def generate_group_aggregates(model, dataset, query_config, train_config):
+    # per label group sample count and numeric column sums, reduced straight from the decoded chunks
+    # rows come out group by group in label code order, so each group is a contiguous segment
+    sample_allocation, sample_rates = get_sample_allocation(model, dataset, query_config, train_config)
+    label_codes, label_counts = get_allocation_label_counts(dataset, sample_allocation)
+    label_codes, label_counts = label_codes[label_counts > 0], label_counts[label_counts > 0]
+    starts = np.cumsum(label_counts) - label_counts
+    sums = np.zeros((len(label_codes), len(dataset.numeric_columns)))
+    st = 0
+    for _, values in compact_sample_chunks(dataset, model, sample_allocation, train_config):
+        ed = st + values.size(0)
+        # groups overlapping the chunk rows [st, ed)
+        first = np.searchsorted(starts, st, side='right') - 1
+        last = np.searchsorted(starts, ed, side='left')
+        offsets = np.maximum(starts[first:last], st) - st
+        sums[first:last] += np.add.reduceat(values.cpu().numpy().astype(np.float64), offsets, axis=0)
+        st = ed
+    label_values = [dataset.label_value_mapping[code] for code in label_codes]
+    rates = np.array([sample_rates[label_value] if label_value in sample_rates else np.nan
+                      for label_value in label_values])
+    return label_values, label_counts, sums, rates
 
 
 def generate_samples_with_allocation(dataset, model, sample_allocation, sample_rates,
                                      train_config):
     start_time = time.perf_counter()
-    batch_size = train_config["batch_size"]
-    latent_dim = train_config["latent_dim"]
-    categorical_encoding = train_config["categorical_encoding"]
-    z_decoded = []
-    label_value_mapping = dataset.label_value_mapping
-    label_size = len(label_value_mapping)
-    threads=[]
-
-    for label_value_idx, label_value in label_value_mapping.items():
-        if label_value in sample_allocation:
-            sample_count = int(sample_allocation[label_value])
-            if categorical_encoding == 'binary':
-                mapping = dataset.label_mapping_out
-                label = [mapping.loc[label_value_idx].values]
-                label = torch.from_numpy(np.repeat(label, batch_size, axis=0)).to(model.device)
-                # label = np.tile(label, (sample_count, 1))
-            else:
-                label = np.ones((batch_size,)) * label_value_idx
-                label = torch.from_numpy(to_categorical(label, label_size)).to(model.device)
-
-            # thread = threading.Thread(target=generate_group_samples,
-            #                           args=(sample_count, label, latent_dim, batch_size, model, dataset, samples))
-            # threads.append(thread)
-            # thread.start()
-            generate_group_samples(sample_count, label, latent_dim, batch_size, model, z_decoded)
-
-    # for t in threads:
-    #     t.join()
-    # print("=====z_decoded: ",z_decoded)
-    z_decoded = np.concatenate(z_decoded, axis=0)
-    samples_df = dataset.decode_samples(z_decoded)
+    codes, values = generate_compact_samples(dataset, model, sample_allocation, train_config)
+    samples_df = dataset.decode_compact_samples(codes, values)
     # print("label_columns:",label_columns)
     # print("label_column_name:",dataset.label_column_name)
     # if len(label_columns)>1:
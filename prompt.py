@@ -3,6 +3,8 @@ from cmd import Cmd
 from utils.sql_parser import parse_query
 from utils.model_sampling import query_multi_sampling, query_sampling
 from utils.evaluation import compare_aggregation, compare_aggregation_norm
+from utils.execution_context import ExecutionContext
+from utils.replicate_executor import process_replicates_supported, run_process_replicates
 from pyspark.sql import SparkSession
 from tabulate import tabulate
 import threading
@@ -16,6 +18,9 @@ logging.basicConfig(level=logging.INFO,#控制台打印的日志级别
                     format='%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s'
                     )
 
+# settings of the set command, with the type of their value, as in the query configuration files
+EXECUTION_SETTINGS = {'num_threads': int, 'interop_threads': int, 'pin_cores': str, 'replicate_executor': str}
+
 class AQPPrompt(Cmd):
     def __init__(self):
         super(AQPPrompt, self).__init__()
@@ -40,6 +45,33 @@ class AQPPrompt(Cmd):
         # self.spark.sql(sql).collect()
         # self.spark.catalog.listColumns("test", "default")
         self.spark =None
+        # query_config style execution settings (num_threads, pin_cores, replicate_executor ...) of the session
+        self.execution_config = {}
+
+    def do_set(self, inp):
+        '''set an execution setting of the session: set num_threads|interop_threads|pin_cores|replicate_executor <value>,
+set <name> alone clears it, set alone shows them.'''
+        args = inp.split()
+        if len(args) == 0:
+            print(self.execution_config)
+            return
+        name = args[0]
+        if name not in EXECUTION_SETTINGS or len(args) > 2:
+            print("usage: set [{} [value]]".format('|'.join(EXECUTION_SETTINGS)))
+            return
+        if len(args) == 1:
+            self.execution_config.pop(name, None)
+            return
+        try:
+            value = EXECUTION_SETTINGS[name](args[1])
+        except ValueError:
+            print("{} takes an integer value".format(name))
+            return
+        if name == 'replicate_executor' and value not in ['thread', 'process']:
+            print("replicate_executor is 'thread' or 'process'")
+            return
+        self.execution_config[name] = value
+        logger.info("execution settings:{}".format(self.execution_config))
 
     # print the exit message.
     def do_exit(self, inp):
@@ -74,20 +106,31 @@ class AQPPrompt(Cmd):
         ### sampling and estimating
         start_time = time.perf_counter()
         multi_sample_times=query.multi_sampling_times
+        execution_context = ExecutionContext(dict(self.execution_config, multi_sample_times=multi_sample_times))
+        execution_context.apply()
         if multi_sample_times<=1:       ### no multi sampling 
             result,training_time = query_sampling(query)
         else:        ### with multi sampling 
             results=[]
             training_times=[]
             threads = []
-            for i in range(multi_sample_times):
-                logger.info("multi_sampling No.{} epoch".format(i))
-                thread = threading.Thread(target=query_multi_sampling,
-                                        args=(query, results,training_times))
-                threads.append(thread)
-                thread.start()
-            for t in threads:
-                t.join()
+            with execution_context.replicates_scope():
+                # processes only when asked for, process_replicates_supported falls back to threads under spark
+                if execution_context.replicate_executor == 'process' and process_replicates_supported():
+                    # every worker process loads its models and sends back only its result
+                    for result,training_time in run_process_replicates(query_sampling, (query,), multi_sample_times,
+                                                                       execution_context):
+                        results.append(result)
+                        training_times.append(training_time)
+                else:
+                    for i in range(multi_sample_times):
+                        logger.info("multi_sampling No.{} epoch".format(i))
+                        thread = threading.Thread(target=query_multi_sampling,
+                                                args=(query, results,training_times,execution_context,i))
+                        threads.append(thread)
+                        thread.start()
+                    for t in threads:
+                        t.join()
             result = pd.concat(results).groupby(level=0).mean()
             training_time=np.sum(training_times)
             
@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from models.pytorch_cvae import CVAE, allocation_label_chunks, get_allocation_label_counts
+
+# compare per-group decoding with fused cross-group decoding as the number of label groups grows, and fused decoding
+# with the cached label part of the first decoder layer
+# usage: python scripts/benchmark_generation.py [total_samples] [group_nums...]
+
+total_samples = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+group_nums = [int(t) for t in sys.argv[2:]] if len(sys.argv) > 2 else [10, 100, 1000, 5000]
+latent_dim = 100
+intermediate_dim = 100
+# two gaussian encoded numeric columns with 5 components and one binary encoded categorical column
+output_info = [(1, 'no'), (5, 'softmax'), (1, 'no'), (5, 'softmax'), (12, 'sigmoid')]
+data_dim = sum(digit for digit, activ in output_info)
+
+
+def generate_with_conditions(model, labels, n, activate=False):
+    # decoding from the full conditions, without the cached label part of the first decoder layer
+    with torch.no_grad():
+        return model.decode(torch.randn(n, latent_dim), labels.expand(n, -1))
+
+
+def decode_allocation(dataset, model, sample_allocation, train_config, label_bias=False):
+    _, label_counts = get_allocation_label_counts(dataset, sample_allocation)
+    z_decoded = np.empty((label_counts.sum(), data_dim), dtype=np.float32)
+    if label_bias:
+        label_table, generate = model.get_label_bias(dataset.label_cache), model.generate_with_bias
+    else:
+        label_table = dataset.label_cache
+        generate = lambda labels, n, activate: generate_with_conditions(model, labels, n, activate)
+    st = 0
+    for each_label in allocation_label_chunks(dataset, label_table, sample_allocation, train_config):
+        ed = st + each_label.size(0)
+        torch.from_numpy(z_decoded[st:ed]).copy_(generate(each_label, ed - st, activate=False))
+        st = ed
+    return z_decoded
+
+
+results = []
+for group_num in group_nums:
+    label_dim = int(np.ceil(np.log2(group_num))) + 1
+    label_cache = torch.tensor([[(code >> (label_dim - 1 - i)) & 1 for i in range(label_dim)]
+                                for code in range(group_num)], dtype=torch.float32)
+    dataset = SimpleNamespace(device=torch.device('cpu'), numeric_columns=['a', 'b'], encoded_output_info=output_info,
+                              label_value_mapping={code: code for code in range(group_num)},
+                              label_cache=label_cache)
+    model = CVAE(data_dim, label_dim, intermediate_dim, latent_dim, dataset)
+    model.eval()
+    counts = np.full(group_num, total_samples // group_num)
+    counts[:total_samples % group_num] += 1
+    sample_allocation = dict(enumerate(counts))
+
+    times = []
+    for mode, label_bias in [('group', False), ('fused', False), ('fused', True)]:
+        train_config = {'batch_size': 512, 'latent_dim': latent_dim, 'categorical_encoding': 'binary',
+                        'generation_mode': mode, 'generation_batch_size': 65536}
+        start_time = time.perf_counter()
+        decode_allocation(dataset, model, sample_allocation, train_config, label_bias)
+        times.append(time.perf_counter() - start_time)
+
+    results.append((group_num, times[0], times[1], times[2], times[0] / times[2]))
+    print("groups:{} group time:{:.4f}s fused time:{:.4f}s cached bias time:{:.4f}s speedup:{:.2f}".format(
+        *results[-1]))
+
+print(pd.DataFrame(results, columns=['groups', 'group_time', 'fused_time', 'bias_time', 'speedup']))
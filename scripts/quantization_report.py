@@ -0,0 +1,50 @@
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from main import compare_aggregation, generate_sample_list, load_models, sample_aggregation
+
+# accuracy versus throughput of the float and the int8 quantized decoder on existing query configs
+# run from the repository root with trained models: python scripts/quantization_report.py config/query/xxx.json ...
+
+query_config_files = sys.argv[1:] if len(sys.argv) > 1 else ['./config/query/customer_join_supplier.json']
+seed = 0
+
+results = []
+for query_config_file in query_config_files:
+    with open(query_config_file) as f:
+        query_config = json.load(f)
+    train_config_list = []
+    for config_file in query_config['train_config_files']:
+        with open(config_file) as f:
+            train_config_list.append(json.load(f))
+    index_flag = len(query_config['groupby_cols']) > 0
+
+    for quantized in ['false', 'true']:
+        configs = [dict(train_config, quantized=quantized) for train_config in train_config_list]
+        model_dataset_list = load_models(configs)
+        if quantized == 'false':
+            # the float baseline is the eager decoder, not a traced decoder exported with the model
+            for model, dataset in model_dataset_list:
+                model.set_serving_decoder(None)
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        start_time = time.perf_counter()
+        sample_list = generate_sample_list(model_dataset_list, query_config, configs)
+        generation_time = time.perf_counter() - start_time
+        rows = sum(len(sample) for sample in sample_list)
+        sample_agg = sample_aggregation(sample_list, query_config, configs)
+        diff = compare_aggregation(sample_agg, query_config, index_flag)
+        results.append((query_config['name'], quantized, rows, generation_time, rows / generation_time,
+                        diff.values.sum() / diff.size))
+        print("query:{} quantized:{} rows:{} generation time:{:.4f}s rows/s:{:.0f} relative error:{:.6f}".format(
+            *results[-1]))
+
+print(pd.DataFrame(results, columns=['query', 'quantized', 'rows', 'generation_time', 'rows_per_second',
+                                     'relative_error']))
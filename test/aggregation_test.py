@@ -0,0 +1,176 @@
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import torch
+
+from fixtures import make_dataset, make_table, make_train_config
+import main
+from models.pytorch_cvae import CVAE, get_sample_allocation, get_allocation_label_counts, generate_compact_samples, \
+    generate_replicate_samples
+
+# streaming, direct and replicate batched aggregation against sample_aggregation of the same samples
+
+QUERY = {"name": "test", "multi_sample_times": 1, "operation": "aqp", "join_cols": [], "groupby_cols": ["k"],
+         "sum_cols": ["v1", "v2"], "avg_cols": ["v1", "v2"]}
+JOIN_QUERY = dict(QUERY, join_cols=["k", "j"], sum_cols=["v1", "w1"], avg_cols=["v2", "w1"])
+TRAIN_CONFIG = make_train_config('table.csv', 'test', 'mm', 'binary')
+JOIN_TRAIN_CONFIG = dict(make_train_config('join.csv', 'join', 'mm', 'binary'), categorical_columns=["j"],
+                         numeric_columns=["w1"], label_columns=["j"])
+
+
+def make_samples(table, name, label_column, seed=0):
+    # fixed samples with a sample rate per label group, as generate_samples returns them
+    rng = np.random.RandomState(seed)
+    labels = table[label_column].unique()
+    rates = dict(zip(labels, rng.uniform(0.05, 0.3, len(labels))))
+    return table.assign(**{'{}_rate'.format(name): table[label_column].map(rates)})
+
+
+def make_join_samples(seed=0):
+    # join keys the first table has and has not, some keys of the first table have no match
+    rng = np.random.RandomState(seed)
+    table = pd.DataFrame({'j': rng.randint(5, 30, 2000), 'w1': rng.gamma(3., 5., 2000)})
+    return make_samples(table, 'join', 'j', seed)
+
+
+@contextmanager
+def replaced(module, **functions):
+    previous = {name: getattr(module, name) for name in functions}
+    for name, function in functions.items():
+        setattr(module, name, function)
+    try:
+        yield
+    finally:
+        for name, function in previous.items():
+            setattr(module, name, function)
+
+
+def assert_aggregation_close(result, expected, rtol=1e-7):
+    assert list(result.columns) == list(expected.columns)
+    assert sorted(result.index) == sorted(expected.index)
+    np.testing.assert_allclose(result.loc[expected.index].values, expected.values, rtol=rtol)
+
+
+def check_streaming(query_config, samples, join_samples=None, chunk_rows=700):
+    train_config_list = [TRAIN_CONFIG] if join_samples is None else [TRAIN_CONFIG, JOIN_TRAIN_CONFIG]
+    sample_list = [samples] if join_samples is None else [samples, join_samples]
+    expected = main.sample_aggregation([sample.copy() for sample in sample_list], query_config, train_config_list)
+    model_dataset_list = [(None, SimpleNamespace(name=train_config['name'], label_column_name='k',
+                                                 categorical_columns=['k', 'cat'], numeric_columns=['v1', 'v2']))
+                          for train_config in train_config_list]
+    assert main.streaming_aggregation_enabled(model_dataset_list, dict(query_config, streaming_aggregation='true'),
+                                              train_config_list)
+    # chunks cut across the groups, the other side of a join is materialized
+    chunks = lambda model, dataset, query_config, train_config: (samples.iloc[st:st + chunk_rows]
+                                                                 for st in range(0, len(samples), chunk_rows))
+    with replaced(main, generate_sample_chunks=chunks,
+                  generate_samples=lambda model, dataset, query_config, train_config: join_samples.copy()):
+        result = main.streaming_sample_aggregation(model_dataset_list, query_config, train_config_list)
+    assert_aggregation_close(result, expected)
+
+
+def test_streaming_single_table():
+    check_streaming(QUERY, make_samples(make_table(), 'test', 'k'))
+
+
+def test_streaming_two_group_by_columns():
+    check_streaming(dict(QUERY, groupby_cols=["k", "cat"]), make_samples(make_table(), 'test', 'k'))
+
+
+def test_streaming_join():
+    samples = make_samples(make_table(), 'test', 'k')
+    check_streaming(JOIN_QUERY, samples, make_join_samples())
+    check_streaming(dict(JOIN_QUERY, groupby_cols=["cat"]), samples, make_join_samples())
+
+
+def make_model(dataset):
+    torch.manual_seed(0)
+    model = CVAE(dataset.numeric_digits + dataset.categorical_digits, dataset.label_size, 30, 20, dataset)
+    model.eval()
+    dataset.build_label_cache()
+    return model
+
+
+def test_direct_aggregation():
+    dataset = make_dataset('mm', 'binary')
+    model = make_model(dataset)
+    # the chunks end inside the groups
+    train_config = dict(TRAIN_CONFIG, generation_batch_size=300)
+    query_config = dict(QUERY, direct_aggregation='true')
+    assert main.direct_aggregation_enabled([(model, dataset)], query_config, [train_config])
+    torch.manual_seed(1)
+    sample_allocation, sample_rates = get_sample_allocation(model, dataset, query_config, train_config)
+    label_codes, label_counts = get_allocation_label_counts(dataset, sample_allocation)
+    _, values = generate_compact_samples(dataset, model, sample_allocation, train_config)
+    # every row under the label it was generated for, the rows come out group by group in label code order
+    samples = pd.DataFrame(values.astype(np.float64), columns=dataset.numeric_columns)
+    samples['k'] = np.repeat([dataset.label_value_mapping[code] for code in label_codes], label_counts)
+    samples['test_rate'] = samples['k'].map(sample_rates)
+    expected = main.sample_aggregation([samples], query_config, [train_config])
+    torch.manual_seed(1)
+    result = main.direct_sample_aggregation([(model, dataset)], query_config, [train_config])
+    assert_aggregation_close(result, expected)
+
+
+def test_replicate_ids():
+    dataset = make_dataset('mm', 'binary')
+    model = make_model(dataset)
+    replicates = 3
+    for generation_mode in ['fused', 'group']:
+        train_config = dict(TRAIN_CONFIG, generation_batch_size=300, generation_mode=generation_mode, batch_size=200)
+        sample_allocation, _ = get_sample_allocation(model, dataset, QUERY, train_config)
+        _, label_counts = get_allocation_label_counts(dataset, sample_allocation)
+        torch.manual_seed(2)
+        samples = generate_replicate_samples(model, dataset, QUERY, train_config, replicates)
+        # every label group is generated as one segment, its replicates follow each other
+        expected = np.concatenate([np.repeat(np.arange(replicates), count) for count in label_counts])
+        np.testing.assert_array_equal(samples['replicate_id'].values, expected)
+        # the rows keep the generation order
+        torch.manual_seed(2)
+        replicate_allocation = {label: int(count) * replicates for label, count in sample_allocation.items()}
+        _, values = generate_compact_samples(dataset, model, replicate_allocation, train_config)
+        np.testing.assert_array_equal(samples[dataset.numeric_columns].values, values)
+
+
+def check_replicate_batching(query_config, sample_lists, train_config_list):
+    # sample_lists: the samples of every replicate of every table
+    replicates = len(sample_lists)
+    query_config = dict(query_config, multi_sample_times=replicates, replicate_batching='true')
+    assert main.replicate_batching_enabled(query_config, train_config_list)
+    batched = [pd.concat([sample_list[i].assign(replicate_id=replicate_id)
+                          for replicate_id, sample_list in enumerate(sample_lists)])
+               for i in range(len(train_config_list))]
+    names = [train_config['name'] for train_config in train_config_list]
+    generate = lambda model, dataset, query_config, train_config, replicates: \
+        batched[names.index(train_config['name'])].copy()
+    model_dataset_list = [(None, None)] * len(train_config_list)
+    with replaced(main, generate_replicate_samples=generate):
+        result = main.replicate_batched_aggregation(model_dataset_list, query_config, train_config_list)
+    for replicate_id, sample_list in enumerate(sample_lists):
+        expected = main.sample_aggregation([sample.copy() for sample in sample_list], query_config,
+                                           train_config_list)
+        assert_aggregation_close(result.xs(replicate_id, level='replicate_id'), expected)
+
+
+def test_replicate_batching_single_table():
+    sample_lists = [[make_samples(make_table(seed=seed), 'test', 'k', seed)] for seed in range(3)]
+    check_replicate_batching(QUERY, sample_lists, [TRAIN_CONFIG])
+
+
+def test_replicate_batching_join():
+    sample_lists = [[make_samples(make_table(seed=seed), 'test', 'k', seed), make_join_samples(seed)]
+                    for seed in range(3)]
+    check_replicate_batching(JOIN_QUERY, sample_lists, [TRAIN_CONFIG, JOIN_TRAIN_CONFIG])
+
+
+if __name__ == '__main__':
+    test_streaming_single_table()
+    test_streaming_two_group_by_columns()
+    test_streaming_join()
+    test_direct_aggregation()
+    test_replicate_ids()
+    test_replicate_batching_single_table()
+    test_replicate_batching_join()
+    print("aggregation ok")
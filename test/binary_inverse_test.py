@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+from fixtures import make_table
+from utils.binary_encoder import BinaryEncoder
+
+# vectorized BinaryEncoder.inverse_transform against the pandas map decoding it replaced
+
+
+def reference_inverse_transform(encoder, X_in):
+    # threshold, basen_to_integer and a map over the categories, codes beyond them come out as NaN
+    X_in = X_in.copy()
+    categorical_columns = [col for col in encoder.feature_names if col not in encoder.numeric_columns]
+    X_in[categorical_columns] = (X_in[categorical_columns] >= 0.5).astype(np.int64)
+    X = encoder.basen_to_integer(X_in[categorical_columns].copy())
+    for col, column_mapping in encoder.column_categories_map.items():
+        if col in encoder.origin_cols:
+            X[col] = X[col].map(pd.Series(data=column_mapping.values(), index=column_mapping.keys()))
+    return X
+
+
+def make_encoder():
+    df = make_table(n=2000)
+    encoder = BinaryEncoder(cols=['k', 'cat'])
+    encoder.fit_transform(df)
+    return encoder
+
+
+def make_bits(encoder, n, seed=0):
+    # random activations, many of them decode to codes beyond the categories
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame(rng.uniform(0, 1, (n, len(encoder.feature_names))), columns=encoder.feature_names)
+
+
+def test_inverse_transform_matches_reference():
+    encoder = make_encoder()
+    X_in = make_bits(encoder, 5000)
+    expected = reference_inverse_transform(encoder, X_in)
+    assert expected.isna().any().all()
+    pd.testing.assert_frame_equal(encoder.inverse_transform(X_in), expected)
+    # arrays of the categorical bit columns decode the same, with a default index
+    categorical_columns = [col for col in encoder.feature_names if col not in encoder.numeric_columns]
+    pd.testing.assert_frame_equal(encoder.inverse_transform(X_in[categorical_columns].values),
+                                  expected.reset_index(drop=True))
+
+
+def test_inverse_transform_in_range_keeps_dtypes():
+    encoder = make_encoder()
+    X_in = make_bits(encoder, 5000)
+    for col in encoder.origin_cols:
+        bit_columns = list(encoder.mapping[col].columns)
+        codes = np.random.RandomState(1).randint(0, encoder.column_category_sizes[col], len(X_in))
+        X_in[bit_columns] = encoder.codes_to_bits(codes, len(bit_columns)).astype(np.float64)
+    result = encoder.inverse_transform(X_in)
+    pd.testing.assert_frame_equal(result, reference_inverse_transform(encoder, X_in))
+    assert result['k'].dtype == np.int64 and result['cat'].dtype == object
+
+
+def test_inverse_transform_clip():
+    encoder = make_encoder()
+    X_in = make_bits(encoder, 5000)
+    expected = reference_inverse_transform(encoder, X_in)
+    result = encoder.inverse_transform(X_in, out_of_range='clip')
+    for col in encoder.origin_cols:
+        last_category = encoder.column_categories_map[col][encoder.column_category_sizes[col] - 1]
+        valid = expected[col].notna()
+        assert (result[col][valid].values == expected[col][valid].values).all()
+        assert (result[col][~valid] == last_category).all()
+
+
+if __name__ == '__main__':
+    test_inverse_transform_matches_reference()
+    test_inverse_transform_in_range_keeps_dtypes()
+    test_inverse_transform_clip()
+    print("binary inverse ok")
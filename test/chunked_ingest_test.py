@@ -0,0 +1,130 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from fixtures import make_table, make_train_config
+from models.pytorch_cvae import train_torch_cvae, load_model_and_dataset, generate_samples, get_sample_allocation
+from utils.dataset_utils import TabularDataset
+
+# the chunked ingest (ingest_chunk_rows) against the in memory ingest of the same csv
+
+QUERY = {"name": "test", "multi_sample_times": 1, "operation": "aqp", "join_cols": [], "groupby_cols": ["k"],
+         "sum_cols": ["v1", "v2"], "avg_cols": ["v1", "v2"]}
+
+
+def label_row_counts(dataset):
+    # training rows of every encoded label, the rows themselves differ once the training rows are sampled
+    rows, counts = np.unique(dataset.raw_label_data.numpy(), axis=0, return_counts=True)
+    return dict(zip(map(tuple, rows), counts))
+
+
+def check_datasets(memory, chunked, exact_rows):
+    assert chunked.total_rows == memory.total_rows
+    assert chunked.train_rows == memory.train_rows
+    assert chunked.data_dim == memory.data_dim
+    assert chunked.label_column_name == memory.label_column_name
+    assert chunked.label_group_counts == memory.label_group_counts
+    assert chunked.label_value_mapping == memory.label_value_mapping
+    assert list(chunked.group_moments.labels) == list(memory.group_moments.labels)
+    np.testing.assert_array_equal(chunked.group_moments.counts, memory.group_moments.counts)
+    np.testing.assert_allclose(chunked.group_moments.means, memory.group_moments.means, rtol=1e-10)
+    np.testing.assert_allclose(chunked.group_moments.m2, memory.group_moments.m2, rtol=1e-8)
+    assert label_row_counts(chunked) == label_row_counts(memory)
+    if exact_rows:
+        np.testing.assert_array_equal(chunked.raw_label_data.numpy(), memory.raw_label_data.numpy())
+        np.testing.assert_allclose(chunked.raw_data.numpy(), memory.raw_data.numpy(), atol=1e-6)
+        if memory.raw_onehot_indices is not None:
+            np.testing.assert_array_equal(chunked.raw_onehot_indices.numpy(), memory.raw_onehot_indices.numpy())
+
+
+def check_round_trip(train_config, memory):
+    # train, save, load and generate from the chunked dataset, the allocation is the one of the in memory dataset
+    train_torch_cvae(train_config)
+    model, dataset = load_model_and_dataset(train_config)
+    sample_allocation, sample_rates = get_sample_allocation(model, dataset, QUERY, train_config)
+    assert (sample_allocation, sample_rates) == get_sample_allocation(model, memory, QUERY, train_config)
+    samples = generate_samples(model, dataset, QUERY, train_config)
+    outlier_rows = len(dataset.outliers) if 'outliers' in train_config else 0
+    assert len(samples) == sum(int(count) for count in sample_allocation.values()) + outlier_rows
+    assert sorted(samples.columns[:-1]) == sorted(dataset.numeric_columns + dataset.categorical_columns)
+
+
+def check_ingest_parity(table, chunk_rows, numeric_encoding='mm', categorical_encoding='binary', round_trip=False,
+                        **options):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            os.mkdir('saved_models')
+            table.to_csv('table.csv', index=False)
+            train_config = make_train_config('table.csv', 'test', numeric_encoding, categorical_encoding)
+            train_config.update(options)
+            np.random.seed(0)
+            memory = TabularDataset(train_config)
+            chunked_config = dict(train_config, name='test_chunked', ingest_chunk_rows=chunk_rows)
+            np.random.seed(0)
+            chunked = TabularDataset(chunked_config)
+            check_datasets(memory, chunked, 'train_reduction_rows' not in options)
+            if 'outliers' in options:
+                assert len(memory.outliers) > 0
+                # the rate column is named after the dataset
+                pd.testing.assert_frame_equal(chunked.outliers.iloc[:, :-1].reset_index(drop=True),
+                                              memory.outliers.iloc[:, :-1].reset_index(drop=True), check_dtype=False)
+            if 'train_reduction_rows' in options:
+                assert chunked.train_reduction_rates == memory.train_reduction_rates
+            if round_trip:
+                check_round_trip(chunked_config, memory)
+        finally:
+            os.chdir(cwd)
+
+
+def make_outlier_table():
+    table = make_table()
+    table.loc[[10, 2500, 4990], 'v1'] = 1e6
+    return table
+
+
+def test_binary():
+    check_ingest_parity(make_table(), 1200)
+
+
+def test_onehot():
+    check_ingest_parity(make_table(), 1200, categorical_encoding='onehot')
+
+
+def test_outliers():
+    check_ingest_parity(make_outlier_table(), 1200, outliers='true')
+
+
+def test_train_reduction():
+    check_ingest_parity(make_table(), 1200, train_reduction_rows=1000)
+
+
+def test_composite_label():
+    check_ingest_parity(make_table(groups=8), 1200, label_columns=['k', 'cat'])
+
+
+def test_missing_integer_labels_after_first_chunk():
+    # the first chunk has no missing key, the integer dtype it gives must still hold the later missing ones
+    table = make_table(n=20000)
+    table['k'] = table['k'].astype('Int64')
+    table.loc[15000:15010, 'k'] = pd.NA
+    check_ingest_parity(table, 5000)
+
+
+def test_round_trip():
+    check_ingest_parity(make_table(), 1200, round_trip=True)
+    check_ingest_parity(make_outlier_table(), 1200, categorical_encoding='onehot', round_trip=True, outliers='true')
+
+
+if __name__ == '__main__':
+    test_binary()
+    test_onehot()
+    test_outliers()
+    test_train_reduction()
+    test_composite_label()
+    test_missing_integer_labels_after_first_chunk()
+    test_round_trip()
+    print("chunked ingest ok")
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import torch
+
+from fixtures import make_dataset
+from models.pytorch_cvae import activate_output_
+
+# decode_logits + decode_compact_samples against decode_samples on the activated decoder output
+
+
+def check_compact_decoding(numeric_encoding, categorical_encoding):
+    dataset = make_dataset(numeric_encoding, categorical_encoding)
+    torch.manual_seed(0)
+    data_dim = sum(digit for digit, activ in dataset.encoded_output_info)
+    logits = torch.randn(4096, data_dim) * 3
+    codes, values = dataset.decode_logits(logits)
+    compact = dataset.decode_compact_samples(codes.numpy(), values.numpy())
+    expected = dataset.decode_samples(activate_output_(logits.clone(), dataset.encoded_output_info).numpy())
+    for col in dataset.categorical_columns:
+        assert compact[col].isna().equals(expected[col].isna()), col
+        valid = expected[col].notna()
+        assert (compact[col][valid].values == expected[col][valid].values).all(), col
+    for col in dataset.numeric_columns:
+        np.testing.assert_allclose(compact[col].values, expected[col].values, rtol=1e-5, atol=1e-4)
+
+
+def test_compact_decoding_gaussian_binary():
+    check_compact_decoding('gaussian', 'binary')
+
+
+def test_compact_decoding_mm_binary():
+    check_compact_decoding('mm', 'binary')
+
+
+def test_compact_decoding_stdmm_onehot():
+    check_compact_decoding('stdmm', 'onehot')
+
+
+if __name__ == '__main__':
+    test_compact_decoding_gaussian_binary()
+    test_compact_decoding_mm_binary()
+    test_compact_decoding_stdmm_onehot()
+    print("compact decoding ok")
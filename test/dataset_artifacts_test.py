@@ -0,0 +1,73 @@
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import pandas as pd
+import torch
+
+from fixtures import make_table, make_train_config
+from utils.dataset_utils import TabularDataset, save_dataset, load_dataset, load_light_dataset, load_origin_data
+
+# save_dataset / load_dataset round trip: the mapped arrays equal the encoded ones and the state pickle is small
+
+
+def row_sized_attributes(dataset, rows):
+    # attributes holding one entry per row of the table or of the training data
+    found = []
+    for name, value in dataset.__dict__.items():
+        if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray, torch.Tensor)) and len(value) >= rows:
+            found.append(name)
+    return found
+
+
+def check_round_trip(numeric_encoding, categorical_encoding):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            os.mkdir('saved_datasets')
+            make_table(n=20000).to_csv('table.csv', index=False)
+            train_config = make_train_config('table.csv', 'test', numeric_encoding, categorical_encoding)
+            np.random.seed(0)
+            dataset = TabularDataset(train_config)
+            rows = len(dataset)
+            data = dataset.raw_data.numpy().copy()
+            label = dataset.raw_label_data.numpy().copy()
+            onehot = dataset.raw_onehot_indices.numpy().copy() if dataset.raw_onehot_indices is not None else None
+            origin = dataset.origin_df.copy()
+            save_dataset(dataset, train_config)
+
+            with open(os.path.join('saved_datasets', dataset.dataset_name), 'rb') as file:
+                state = pickle.load(file)
+            assert row_sized_attributes(state, rows) == []
+            assert os.path.getsize(os.path.join('saved_datasets', dataset.dataset_name)) < data.nbytes / 10
+
+            loaded = load_dataset(train_config)
+            np.testing.assert_array_equal(loaded.raw_data.numpy(), data)
+            np.testing.assert_array_equal(loaded.raw_label_data.numpy(), label)
+            if onehot is not None:
+                np.testing.assert_array_equal(loaded.raw_onehot_indices.numpy(), onehot)
+            assert loaded.label_value_mapping == dataset.label_value_mapping
+            assert len(loaded) == rows
+            # the light dataset serves queries from the same pickle without mapping the arrays
+            light = load_light_dataset(train_config)
+            assert light.raw_data is None and light.label_df is None
+            assert light.label_value_mapping == dataset.label_value_mapping
+            pd.testing.assert_frame_equal(load_origin_data(train_config), origin)
+        finally:
+            os.chdir(cwd)
+
+
+def test_round_trip_gaussian_binary():
+    check_round_trip('gaussian', 'binary')
+
+
+def test_round_trip_mm_onehot():
+    check_round_trip('mm', 'onehot')
+
+
+if __name__ == '__main__':
+    test_round_trip_gaussian_binary()
+    test_round_trip_mm_onehot()
+    print("dataset artifacts ok")
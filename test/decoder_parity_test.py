@@ -0,0 +1,85 @@
+import os
+import tempfile
+
+import torch
+
+from fixtures import make_dataset, make_train_config
+from models.pytorch_cvae import CVAE, export_traced_decoder, quantize_decoder, activate_output_
+from utils.model_utils import load_traced_decoder, get_weights_digest
+
+# the exported TorchScript decoder and the int8 quantized decoder against the eager CVAE.decode
+
+
+def make_model(dataset):
+    torch.manual_seed(0)
+    model = CVAE(dataset.numeric_digits + dataset.categorical_digits, dataset.label_size, 30, 20, dataset)
+    model.eval()
+    dataset.build_label_cache()
+    return model
+
+
+def check_decoder_parity(decoder, model, dataset, atol=1e-5):
+    label_cache = dataset.label_cache
+    codes = torch.arange(1000) % label_cache.size(0)
+    with torch.no_grad():
+        z = torch.randn(len(codes), model.latent_dim)
+        label_bias = model.get_label_bias(label_cache).index_select(0, codes)
+        expected = model.decode(z, label_cache.index_select(0, codes))
+        torch.testing.assert_close(decoder(z, label_bias), expected, rtol=1e-5, atol=atol)
+        expected = activate_output_(expected, model.output_info)
+        torch.testing.assert_close(decoder.activated(z, label_bias), expected, rtol=1e-5, atol=atol)
+
+
+def check_traced_decoder(numeric_encoding, categorical_encoding):
+    dataset = make_dataset(numeric_encoding, categorical_encoding)
+    model = make_model(dataset)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            os.mkdir('saved_models')
+            train_config = make_train_config('table.csv', 'test', numeric_encoding, categorical_encoding)
+            assert export_traced_decoder(model, dataset, train_config) is not None
+            decoder = load_traced_decoder(train_config, get_weights_digest(model))
+            assert decoder is not None
+            check_decoder_parity(decoder, model, dataset)
+            # weights changed after the export, the saved decoder must not be served
+            with torch.no_grad():
+                model.fc4.bias.add_(1.)
+            assert load_traced_decoder(train_config, get_weights_digest(model)) is None
+        finally:
+            os.chdir(cwd)
+
+
+def check_quantized_decoder(numeric_encoding, categorical_encoding):
+    dataset = make_dataset(numeric_encoding, categorical_encoding)
+    model = make_model(dataset)
+    decoder = quantize_decoder(model)
+    # int8 weights, the outputs only agree up to the quantization error
+    check_decoder_parity(decoder, model, dataset, atol=0.1)
+    model.set_serving_decoder(decoder)
+    assert not any(name.startswith('serving_decoder') for name in model.state_dict())
+
+
+def test_traced_decoder_gaussian_binary():
+    check_traced_decoder('gaussian', 'binary')
+
+
+def test_traced_decoder_mm_onehot():
+    check_traced_decoder('mm', 'onehot')
+
+
+def test_quantized_decoder_gaussian_binary():
+    check_quantized_decoder('gaussian', 'binary')
+
+
+def test_quantized_decoder_mm_onehot():
+    check_quantized_decoder('mm', 'onehot')
+
+
+if __name__ == '__main__':
+    test_traced_decoder_gaussian_binary()
+    test_traced_decoder_mm_onehot()
+    test_quantized_decoder_gaussian_binary()
+    test_quantized_decoder_mm_onehot()
+    print("decoder parity ok")
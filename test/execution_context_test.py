@@ -0,0 +1,41 @@
+import torch
+
+import fixtures  # noqa: F401, puts the repository root on sys.path
+from utils.execution_context import ExecutionContext
+
+# thread counts around the replicates scope
+
+
+def test_replicates_scope_restores_threads():
+    previous = torch.get_num_threads()
+    execution_context = ExecutionContext({'multi_sample_times': 2, 'num_threads': 2})
+    try:
+        torch.set_num_threads(3)
+        try:
+            with execution_context.replicates_scope():
+                assert torch.get_num_threads() == 1
+                raise KeyError('replicate failed')
+        except KeyError:
+            pass
+        assert torch.get_num_threads() == 3
+    finally:
+        torch.set_num_threads(previous)
+
+
+def test_apply_runs_once():
+    previous = torch.get_num_threads()
+    execution_context = ExecutionContext({'num_threads': 2})
+    try:
+        execution_context.apply()
+        assert torch.get_num_threads() == 2
+        torch.set_num_threads(1)
+        execution_context.apply()
+        assert torch.get_num_threads() == 1
+    finally:
+        torch.set_num_threads(previous)
+
+
+if __name__ == '__main__':
+    test_replicates_scope_restores_threads()
+    test_apply_runs_once()
+    print("execution context ok")
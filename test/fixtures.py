@@ -0,0 +1,38 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.dataset_utils import TabularDataset
+
+# small synthetic tables and datasets shared by the regression checks in this directory
+
+
+def make_table(n=5000, groups=20, seed=0):
+    rng = np.random.RandomState(seed)
+    k = rng.randint(0, groups, n)
+    return pd.DataFrame({'k': k, 'cat': rng.choice(['x', 'y', 'z'], n),
+                         'v1': rng.gamma(2., 10., n) + k, 'v2': rng.normal(100, 5, n) * (1 + k % 3)})
+
+
+def make_train_config(path, name, numeric_encoding='gaussian', categorical_encoding='binary'):
+    return {"name": name, "data": path, "categorical_columns": ["k", "cat"], "numeric_columns": ["v1", "v2"],
+            "label_columns": ["k"], "bucket_columns": [], "categorical_encoding": categorical_encoding,
+            "numeric_encoding": numeric_encoding, "max_clusters": 5, "model_type": "torch_cvae", "lr": 0.001,
+            "optimizer_type": "adam", "loss_agg_type": "mean", "gpu_num": 0, "epochs": 1, "batch_size": 512,
+            "latent_dim": 20, "intermediate_dim": 30, "train_flag": "train", "operation": "aqp",
+            "sample_method": "statistics", "sample_rate": 0.1, "sample_for_train": 1, "header": 1, "delimiter": ","}
+
+
+def make_dataset(numeric_encoding='gaussian', categorical_encoding='binary', seed=0, **options):
+    # an in memory TabularDataset of make_table, the csv lives in a temporary directory
+    np.random.seed(seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'table.csv')
+        make_table(seed=seed).to_csv(path, index=False)
+        train_config = make_train_config(path, 'test', numeric_encoding, categorical_encoding)
+        train_config.update(options)
+        return TabularDataset(train_config)
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+from fixtures import make_table
+from utils.gaussian_encoder import GaussianEncoder
+
+# vectorized GaussianEncoder.transform against the per-row np.random.choice loop it replaced, under the same seed
+
+
+def reference_transform(encoder, data):
+    column_data_list = []
+    for col in encoder.cols:
+        column_data = data[[col]].values
+        gm = encoder.gms[col].gm
+        valid_component_indicator = encoder.gms[col].valid
+        num_components = valid_component_indicator.sum()
+        means = gm.means_.reshape((1, encoder.max_clusters))
+        stds = np.sqrt(gm.covariances_).reshape((1, encoder.max_clusters))
+        normalized_values = ((column_data - means) / (4 * stds))[:, valid_component_indicator]
+        component_probs = gm.predict_proba(column_data)[:, valid_component_indicator]
+        selected_component = np.zeros(len(column_data), dtype='int')
+        for i in range(len(column_data)):
+            component_porb_t = component_probs[i] + 1e-6
+            component_porb_t = component_porb_t / component_porb_t.sum()
+            selected_component[i] = np.random.choice(np.arange(num_components), p=component_porb_t)
+        selected_normalized_value = normalized_values[np.arange(len(column_data)), selected_component]
+        selected_component_onehot = np.zeros_like(component_probs)
+        selected_component_onehot[np.arange(len(column_data)), selected_component] = 1
+        column_data_list.append(np.clip(selected_normalized_value, -.99, .99).reshape([-1, 1]))
+        column_data_list.append(selected_component_onehot)
+    return pd.DataFrame(np.concatenate(column_data_list, axis=1), columns=encoder.get_feature_names())
+
+
+def make_encoder(chunk_size=1000000):
+    np.random.seed(0)
+    df = make_table(n=3000)
+    encoder = GaussianEncoder(['v1', 'v2'], max_clusters=5, chunk_size=chunk_size)
+    encoder.fit(df)
+    return encoder, df
+
+
+def test_transform_matches_reference():
+    encoder, df = make_encoder()
+    np.random.seed(7)
+    expected = reference_transform(encoder, df)
+    np.random.seed(7)
+    pd.testing.assert_frame_equal(encoder.transform(df), expected)
+
+
+def test_transform_chunks():
+    # the uniforms are drawn chunk after chunk, so the chunk size does not change the encoding
+    encoder, df = make_encoder(chunk_size=701)
+    np.random.seed(7)
+    expected = reference_transform(encoder, df)
+    np.random.seed(7)
+    out = np.full((len(df), encoder.total_digits), np.nan)
+    encoder.transform(df, out=out)
+    np.testing.assert_array_equal(out, expected.values)
+
+
+def test_sample_components_matches_choice():
+    rng = np.random.RandomState(3)
+    component_probs = rng.dirichlet(np.full(4, 0.3), 5000)
+    np.random.seed(11)
+    expected = [np.random.choice(np.arange(4), p=(p + 1e-6) / (p + 1e-6).sum()) for p in component_probs]
+    np.random.seed(11)
+    np.testing.assert_array_equal(GaussianEncoder.sample_components(component_probs), expected)
+
+
+if __name__ == '__main__':
+    test_transform_matches_reference()
+    test_transform_chunks()
+    test_sample_components_matches_choice()
+    print("gaussian transform ok")
@@ -0,0 +1,62 @@
+import numpy as np
+
+from fixtures import make_table
+from utils.dataset_utils import group_moments, merge_group_moments
+
+# per label group count, mean and M2 from bincounts and their pairwise merge, against pandas groupby
+
+
+def make_moment_table(seed=0):
+    df = make_table(n=6000, groups=30, seed=seed)
+    rng = np.random.RandomState(seed)
+    # missing values in the numeric and the label columns
+    df.loc[rng.choice(len(df), 300, replace=False), 'v1'] = np.nan
+    df.loc[rng.choice(len(df), 50, replace=False), 'k'] = np.nan
+    return df
+
+
+def check_moments(moments, df):
+    grouped = df.groupby('k')[['v1', 'v2']]
+    assert list(moments.labels) == list(grouped.size().index)
+    np.testing.assert_array_equal(moments.counts, grouped.count().values)
+    np.testing.assert_allclose(moments.means, grouped.mean().values, rtol=1e-10)
+    # M2 / (count - 1) is the sample variance of groupby
+    np.testing.assert_allclose(moments.m2 / (moments.counts - 1), grouped.var().values, rtol=1e-8)
+
+
+def test_group_moments_match_groupby():
+    df = make_moment_table()
+    check_moments(group_moments(df, 'k', ['v1', 'v2']), df)
+
+
+def test_merged_chunks_match_whole_table():
+    df = make_moment_table()
+    moments = None
+    # uneven chunks, the first ones miss some of the label groups
+    for st, ed in [(0, 40), (40, 1000), (1000, 1001), (1001, 4500), (4500, len(df))]:
+        moments = merge_group_moments(moments, group_moments(df.iloc[st:ed], 'k', ['v1', 'v2']))
+    whole = group_moments(df, 'k', ['v1', 'v2'])
+    assert moments.labels.equals(whole.labels)
+    np.testing.assert_array_equal(moments.counts, whole.counts)
+    np.testing.assert_allclose(moments.means, whole.means, rtol=1e-10)
+    np.testing.assert_allclose(moments.m2, whole.m2, rtol=1e-8)
+    check_moments(moments, df)
+
+
+def test_merge_is_order_independent():
+    df = make_moment_table(seed=1)
+    a = group_moments(df.iloc[:2500], 'k', ['v1', 'v2'])
+    b = group_moments(df.iloc[2500:], 'k', ['v1', 'v2'])
+    ab = merge_group_moments(a, b)
+    ba = merge_group_moments(b, a)
+    assert ab.labels.equals(ba.labels)
+    np.testing.assert_array_equal(ab.counts, ba.counts)
+    np.testing.assert_allclose(ab.means, ba.means, rtol=1e-10)
+    np.testing.assert_allclose(ab.m2, ba.m2, rtol=1e-8)
+
+
+if __name__ == '__main__':
+    test_group_moments_match_groupby()
+    test_merged_chunks_match_whole_table()
+    test_merge_is_order_independent()
+    print("group moments ok")
@@ -0,0 +1,52 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from fixtures import make_dataset
+from models.pytorch_cvae import senate_sampling, advance_senate_sampling, statistics_sampling
+from utils.stratified_sampling import senate_allocation
+
+# train_reduction_rows reduces the training rows only, the query time sample allocation stays the same
+
+MODEL = SimpleNamespace(eval=lambda: None)
+QUERY = {'sum_cols': ['v1', 'v2'], 'avg_cols': ['v1', 'v2']}
+
+
+def test_reduction_keeps_allocation():
+    full = make_dataset('mm', 'binary')
+    reduced = make_dataset('mm', 'binary', train_reduction_rows=1000)
+    assert reduced.total_rows == full.total_rows == 5000
+    # the larger groups are rounded down
+    assert 950 < reduced.train_rows <= 1000
+    assert reduced.train_rows == len(reduced) == len(reduced.raw_data) == len(reduced.raw_label_data)
+    assert reduced.label_group_counts == full.label_group_counts
+    assert reduced.label_value_mapping == full.label_value_mapping
+    for sampling in [senate_sampling, advance_senate_sampling]:
+        assert sampling(MODEL, reduced, 0.1) == sampling(MODEL, full, 0.1)
+    reduced_allocation, _ = statistics_sampling(MODEL, reduced, 0.1, QUERY)
+    full_allocation, _ = statistics_sampling(MODEL, full, 0.1, QUERY)
+    assert reduced_allocation == full_allocation
+
+
+def test_reduction_rates():
+    reduced = make_dataset('mm', 'binary', train_reduction_rows=1000)
+    assert reduced.train_reduction_rate == reduced.train_rows / 5000
+    for label, rate in reduced.train_reduction_rates.items():
+        assert 0 < rate <= 1
+        assert round(rate * reduced.label_group_counts[label]) >= 1
+
+
+def test_senate_allocation():
+    counts = np.array([0, 10, 50, 400, 4540])
+    allocation = senate_allocation(counts, 1000)
+    # groups under the even share of 250 rows are kept whole, the others share the rest by size
+    assert list(allocation[:3]) == [0, 10, 50]
+    assert allocation.sum() <= 1000 and (allocation <= counts).all()
+    assert allocation[4] > allocation[3]
+
+
+if __name__ == '__main__':
+    test_reduction_keeps_allocation()
+    test_reduction_rates()
+    test_senate_allocation()
+    print("train reduction ok")
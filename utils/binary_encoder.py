@@ -23,17 +23,20 @@ class BinaryEncoder():
             digits = int(np.ceil(math.log(len(values), self.base))) + 1
         return digits
 
-    def fit_base_n_encoding(self, df):
+    def fit_base_n_encoding(self, df, column_categories=None):
         self.column_category_sizes = {}
         self.column_categories_map = {}
         self.column_digits = {}
-        self.numeric_columns = [col for col in df.columns if col not in self.cols]
+        self.numeric_columns = [col for col in df.columns if col not in self.cols] if df is not None else []
         mappings_out = {}  # []
 
         for col_name in self.cols:
-            column = df[col_name].astype("category")
-            self.column_categories_map[col_name] = dict(enumerate(column.cat.categories))
-            self.column_category_sizes[col_name] = len(column.cat.categories)
+            if column_categories is not None:
+                categories = column_categories[col_name]
+            else:
+                categories = df[col_name].astype("category").cat.categories
+            self.column_categories_map[col_name] = dict(enumerate(categories))
+            self.column_category_sizes[col_name] = len(categories)
             if self.label != None and self.label == col_name:
                 self.label_value_mapping = self.column_categories_map[col_name]
 
@@ -42,7 +45,7 @@ class BinaryEncoder():
             self.column_digits[col] = digits
             X_unique = pd.DataFrame(index=values,
                                     columns=[str(col) + '_%d' % x for x in range(digits)],
-                                    data=np.array([self.col_transform(x, digits) for x in range(0, len(values))]))
+                                    data=self.codes_to_bits(np.arange(len(values)), digits).astype(np.int64))
             mappings_out[col] = X_unique
             # mappings_out.append({'col': col, 'mapping': X_unique})
         return mappings_out
@@ -79,6 +82,51 @@ class BinaryEncoder():
     def fit(self, df):
         self.mapping = self.fit_base_n_encoding(df)
 
+    def fit_categories(self, column_categories):
+        """
+        column_categories: sorted categories of every column, as astype("category") finds them, e.g. collected
+            chunk by chunk from a table that does not fit in memory
+        """
+        self.mapping = self.fit_base_n_encoding(None, column_categories)
+
+    def codes_to_bits(self, codes, digits, out=None):
+        """
+        codes: integer category codes, -1 for values outside the fitted categories
+        digits: bits of the column, most significant first
+        out: optional (n, digits) array the bits are written to
+        return: bit matrix, uint8 unless out is given
+        """
+        if out is None:
+            out = np.empty((len(codes), digits), dtype=np.uint8)
+        for i in range(digits):
+            # -1 sets every bit, a code no category has, so unseen values decode as out of range
+            out[:, i] = (codes >> (digits - 1 - i)) & 1
+        return out
+
+    def transform_bits(self, X_in, out=None):
+        """
+        X_in: DataFrame with the fitted categorical columns
+        out: optional preallocated (n, total bits) array the bits are written to, e.g. a block of the training matrix
+        return: bit matrix (uint8 unless out is given) and its layout, a (column, start, digits) triple per column
+        """
+        cols = [col for col in X_in.columns if col in self.mapping]
+        layout = []
+        st = 0
+        for col in cols:
+            layout.append((col, st, self.column_digits[col]))
+            st += self.column_digits[col]
+        if out is None:
+            out = np.empty((len(X_in), st), dtype=np.uint8)
+        for col, st, digits in layout:
+            categories = list(self.column_categories_map[col].values())
+            codes = pd.Categorical(X_in[col], categories=categories).codes
+            self.codes_to_bits(codes, digits, out[:, st:st + digits])
+        self.feature_names = [name for col in cols for name in self.mapping[col].columns]
+        if self.label != None and self.label not in self.origin_cols:
+            self.feature_names = [col for col in self.feature_names if not col.startswith(self.label)]
+        self.inverse_plan = None
+        return out, layout
+
     def transform(self, X_in):
         X = X_in.copy(deep=True)
         for col_name in self.cols:
@@ -128,24 +176,51 @@ class BinaryEncoder():
             out_cols = X.columns.values.tolist()
         return X
 
-    def inverse_transform(self, X_in):
-        if not isinstance(X_in, pd.DataFrame):
-            X_in = pd.DataFrame(X_in, columns=self.feature_names)
-        categorical_columns = [col for col in self.feature_names if col not in self.numeric_columns]
-        print("categorical_columns:",categorical_columns)
-        X_in[categorical_columns] = X_in[categorical_columns].applymap(lambda x: 1 if x >= 0.5 else 0)
-        X_in2=X_in[categorical_columns]
-        # numeric_df = X_in[self.numeric_columns]
-        # X_in = X_in.applymap(lambda x: 1 if x >= 0.5 else 0)
-        # X_in[self.feature_names] = numeric_df
-        X = self.basen_to_integer(X_in2)
-        for col, column_mapping in self.column_categories_map.items():
-            if col in self.origin_cols:
-                # column_mapping = self.column_categories_map[switch]
-                inverse = pd.Series(data=column_mapping.values(), index=column_mapping.keys())
-                X[col] = X[col].map(inverse)  # .astype(switch.get('data_type'))
-        X.fillna(method='ffill')
-        return X
+    def get_inverse_plan(self):
+        # bit positions, powers of two and category values of every column, built once for inverse_transform
+        if getattr(self, 'inverse_plan', None) is None:
+            categorical_columns = [col for col in self.feature_names if col not in self.numeric_columns]
+            positions = {col: i for i, col in enumerate(categorical_columns)}
+            plan = []
+            for col in self.origin_cols:
+                bits = np.array([positions[col0] for col0 in self.mapping[col].columns], dtype=np.int64)
+                powers = np.array([self.base ** (len(bits) - 1 - i) for i in range(len(bits))], dtype=np.int64)
+                categories = pd.Index(list(self.column_categories_map[col].values())).values
+                plan.append((col, bits, powers, categories))
+            # columns come out in the order of their bits, as basen_to_integer inserts them
+            plan.sort(key=lambda x: x[1][0])
+            self.inverse_plan = (categorical_columns, plan)
+        return self.inverse_plan
+
+    def inverse_transform(self, X_in, out_of_range='nan'):
+        """
+        X_in: encoded bit columns (DataFrame or array), a bit is set when it is >= 0.5
+        out_of_range: policy for codes beyond the categories of a column,
+            'nan' leaves them missing and 'clip' maps them to the last category
+        return: DataFrame of the decoded categorical columns
+        """
+        categorical_columns, plan = self.get_inverse_plan()
+        if isinstance(X_in, pd.DataFrame):
+            index = X_in.index
+            X_in = X_in[categorical_columns].values
+        else:
+            index = None
+        bits = np.asarray(X_in) >= 0.5
+        out = {}
+        for col, bit_idx, powers, categories in plan:
+            codes = bits[:, bit_idx].astype(np.int64) @ powers
+            invalid = codes >= len(categories)
+            if not invalid.any():
+                out[col] = np.take(categories, codes)
+            elif out_of_range == 'clip':
+                out[col] = np.take(categories, np.minimum(codes, len(categories) - 1))
+            elif out_of_range == 'nan':
+                # missing values need a float or object column, as pandas map would give
+                values = categories.astype(np.float64 if categories.dtype.kind in 'iuf' else object)
+                out[col] = np.where(invalid, np.nan, np.take(values, np.where(invalid, 0, codes)))
+            else:
+                raise ValueError("unknown out_of_range policy: {}".format(out_of_range))
+        return pd.DataFrame(out, index=index)
 
     def fit_transform(self, df):
         self.fit(df)
@@ -2,6 +2,7 @@
 import math
 import time
 import pickle
+import json
 import os
 from torch.utils.data import Dataset
 import pandas as pd
@@ -9,11 +10,23 @@ import torch
 import numpy as np
 from sklearn.preprocessing import StandardScaler, MinMaxScaler, OneHotEncoder
 import logging
+from collections import namedtuple
 
 from utils.binary_encoder import BinaryEncoder
 from utils.gaussian_encoder import GaussianEncoder
+from utils.stratified_sampling import stratified_quota_index, stratified_quotas, senate_allocation
 logger = logging.getLogger(__name__)
 
+# layout of the saved dataset artifacts, see save_dataset
+DATASET_FORMAT_VERSION = 1
+
+# rows of the uniform sample the chunked ingest takes the outlier quantiles from, see estimate_outlier_bounds
+OUTLIER_SAMPLE_ROWS = 1000000
+
+# labels: sorted label values, i.e. the label codes of label_value_mapping
+# counts, means, m2: (groups, columns) arrays of the non missing values of every numeric column per label
+GroupMoments = namedtuple("GroupMoments", ["labels", "counts", "means", "m2"])
+
 
 class TabularDataset(Dataset):
     def __init__(self, param):
@@ -26,85 +39,35 @@ class TabularDataset(Dataset):
         self.categorical_encoding = param['categorical_encoding']
         self.numeric_encoding = param['numeric_encoding']
         self.sample_for_train = param['sample_for_train']
-        self.load_data(param)
-        encoded_categorical = None
-        encoded_numeric = None
-        start_time = time.perf_counter()
-
-        if len(self.all_categorical_columns) > 0:
-            categorical_data = self.origin_df[self.all_categorical_columns]
-            if self.categorical_encoding == 'binary':
-                encoded_categorical = self.encode_categorical_data_binary(categorical_data)
-                self.label = self.encode_label_binary(self.label_df[[self.label_column_name]])
-            else:
-                encoded_categorical = self.encode_categorical_data_one_hot(categorical_data)
-                self.label = self.encode_label_binary(self.label_df[[self.label_column_name]])
-        end_time = time.perf_counter()
-        logger.info('encode categorical columns time elapsed:{}'.format(end_time - start_time))
-
-        start_time = time.perf_counter()
-        if len(self.numeric_columns) > 0:
-            numeric_data = self.origin_df[self.numeric_columns]
-            if self.numeric_encoding == 'gaussian':
-                self.gaussian_max_clusters = param["max_clusters"]
-                encoded_numeric = self.encode_numeric_data_gaussian(numeric_data)
-            elif self.numeric_encoding == 'stdmm':
-                encoded_numeric = self.encode_numeric_data_stdmm(numeric_data)
-            else:
-                encoded_numeric = self.encode_numeric_data_mm(numeric_data)
-        end_time = time.perf_counter()
-        logger.info('encode numeric columnstime elapsed:{}'.format(end_time - start_time))
-
-        if encoded_categorical is None:
-            self.data = encoded_numeric
-        elif encoded_numeric is None:
-            self.data = encoded_categorical
+        # one-hot categorical data is kept as int32 positions and densified per mini-batch
+        self.raw_onehot_indices = None
+        self.onehot_digits = 0
+        # count, mean and M2 of the numeric columns per label group, see group_moments
+        self.group_moments = None
+        # .npy files of the encoded arrays when they are written to disk by the chunked ingest
+        self.encoded_paths = None
+        if 'ingest_chunk_rows' in param:
+            # tables larger than memory: a statistics pass and an encoding pass over chunks of the csv
+            encoded_data = self.encode_data_chunked(param)
         else:
-            self.data = pd.concat([encoded_numeric.reset_index(drop=True), encoded_categorical.reset_index(drop=True)],
-                                  axis=1)
+            self.load_data(param)
+            encoded_data = self.encode_data(param)
+            # the label rows are only needed to encode, they would be pickled with the dataset otherwise
+            self.label_df = None
 
         if self.label_column_name is not None:
             # collect variance and mean of each numeric columns for each label group
-            self.label_group_stds = {}
-            self.label_group_means = {}
-            self.label_group_relative_stds = {}
-            self.label_group_relative_stds_sums = {}
-            self.label_group_relative_stds_with_num = {}
-            self.label_group_relative_stds_with_num_sums = {}
-            for col in self.numeric_columns:
-                self.label_group_stds[col] = self.label_df.groupby(self.label_column_name)[col].std(ddof=0).to_dict()
-                self.label_group_means[col] = self.label_df.groupby(self.label_column_name)[col].mean().to_dict()
-
-                # print("==========self.label_group_stds: ",self.label_group_stds)
-                # print("==========self.label_group_means: ",self.label_group_means)
-                # print("==========self.origin_df.isnull().sum(): ",self.origin_df.isnull().sum())
-                self.label_group_relative_stds[col] = {
-                    k: self.label_group_stds[col][k] / self.label_group_means[col][k] if self.label_group_means[col][
-                                                                                             k] != 0 else 0
-                    for k in self.label_group_stds[col]}
-
-                self.label_group_relative_stds_sums[col] = sum(self.label_group_relative_stds[col].values())
-
-                # print("==========label_group_relative_stds: ",self.label_group_relative_stds)
-                # print("==========label_group_relative_stds_sums: ",self.label_group_relative_stds_sums)
-
-
-                self.label_group_relative_stds_with_num[col] = {
-                    k: self.label_group_relative_stds[col][k] * math.sqrt(self.label_group_counts[k])
-                    for k in self.label_group_stds[col]}
-                self.label_group_relative_stds_with_num_sums[col] = sum(
-                    self.label_group_relative_stds_with_num[col].values())
-
+            self.update_label_group_stats()
             # self.label = self.data.iloc[:, self.data.columns.str.contains(self.label_column_name)]
             self.label_size = self.label.shape[1]
         else:
-            self.label = pd.DataFrame(np.zeros((self.total_rows, 1)))
+            self.label = pd.DataFrame(np.zeros((self.train_rows, 1)))
             self.label_size = 0
         self.feature_data=self.data
         # if self.label_column_name not in self.all_columns:
         #     self.feature_data.drop([t for t in self.feature_data.columns if self.label_column_name in t],axis=1,inplace=True)
-        self.data_dim = self.feature_data.shape[1]
-        logger.info("data shape:{}".format(self.feature_data.shape))
+        self.data_dim = self.feature_data.shape[1] + self.onehot_digits
+        logger.info("data shape:{}".format((len(self.feature_data), self.data_dim)))
 
         self.numeric_digits = 0
         self.categorical_digits = 0
@@ -135,11 +98,401 @@ class TabularDataset(Dataset):
 
         logger.info('feature info:{}'.format(self.feature_info))
         logger.info("output info list:{}".format(self.encoded_output_info))
-        self.raw_data = torch.from_numpy(self.feature_data.values.astype("float32")).to(self.device)
-        self.raw_label_data = torch.from_numpy(self.label.values.astype("float32")).to(self.device)
+        # the tensors share the memory of the float32 matrices on cpu
+        self.raw_data = torch.from_numpy(encoded_data).to(self.device)
+        self.raw_label_data = torch.from_numpy(np.ascontiguousarray(self.label.values, dtype=np.float32)).to(
+            self.device)
+        if self.raw_onehot_indices is not None:
+            self.raw_onehot_indices = self.raw_onehot_indices.to(self.device)
         logger.info('load data successfully')
 
+    def encode_data(self, param):
+        # fits the encoders on the table loaded in memory and returns the encoded matrix
+        start_time = time.perf_counter()
+        # the encoders are fitted first, then each of them writes its block of one preallocated float32 matrix
+        categorical_digits = 0
+        if len(self.all_categorical_columns) > 0:
+            categorical_data = self.origin_df[self.all_categorical_columns]
+            if self.categorical_encoding == 'binary':
+                categorical_digits = self.fit_categorical_data_binary(categorical_data)
+            else:
+                self.raw_onehot_indices = torch.from_numpy(self.encode_categorical_data_one_hot(categorical_data))
+            self.label = self.encode_label_binary(self.label_df[[self.label_column_name]], self.origin_df.index)
+        numeric_digits = 0
+        if len(self.numeric_columns) > 0:
+            numeric_data = self.origin_df[self.numeric_columns]
+            if self.numeric_encoding == 'gaussian':
+                self.gaussian_max_clusters = param["max_clusters"]
+                self.gmm_fit_processes = param['gmm_fit_processes'] if 'gmm_fit_processes' in param else 1
+                self.gmm_fit_sample_size = param['gmm_fit_sample_size'] if 'gmm_fit_sample_size' in param else None
+                numeric_digits = self.fit_numeric_data_gaussian(numeric_data)
+            elif self.numeric_encoding == 'stdmm':
+                numeric_digits = self.fit_numeric_data_stdmm(numeric_data)
+            else:
+                numeric_digits = self.fit_numeric_data_mm(numeric_data)
+        end_time = time.perf_counter()
+        logger.info('fit encoders time elapsed:{}'.format(end_time - start_time))
+
+        encoded_data = np.empty((len(self.origin_df), numeric_digits + categorical_digits), dtype=np.float32)
+        column_names = []
+        start_time = time.perf_counter()
+        if len(self.numeric_columns) > 0:
+            numeric_block = encoded_data[:, :numeric_digits]
+            if self.numeric_encoding == 'gaussian':
+                column_names += self.encode_numeric_data_gaussian(numeric_data, numeric_block)
+            else:
+                column_names += self.encode_numeric_data_mm(numeric_data, numeric_block)
+        end_time = time.perf_counter()
+        logger.info('encode numeric columnstime elapsed:{}'.format(end_time - start_time))
+
+        start_time = time.perf_counter()
+        if categorical_digits > 0:
+            column_names += self.encode_categorical_data_binary(categorical_data, encoded_data[:, numeric_digits:])
+        end_time = time.perf_counter()
+        logger.info('encode categorical columns time elapsed:{}'.format(end_time - start_time))
+        self.data = pd.DataFrame(encoded_data, columns=column_names, copy=False)
+        return encoded_data
+
+
+    def update_label_group_stats(self):
+        # std, mean and relative std dictionaries of every numeric column, derived from the group moments
+        labels = self.group_moments.labels
+        counts = self.group_moments.counts
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # groups without values of a column have no mean and no std, as in pandas
+            means = np.where(counts > 0, self.group_moments.means, np.nan)
+            stds = np.sqrt(self.group_moments.m2 / counts)
+            relative_stds = np.where(means != 0, stds / means, 0)
+        row_counts = np.array([self.label_group_counts.get(label, 0) for label in labels], dtype=np.float64)
+        relative_stds_with_num = relative_stds * np.sqrt(row_counts).reshape([-1, 1])
+        self.label_group_stds = {}
+        self.label_group_means = {}
+        self.label_group_relative_stds = {}
+        self.label_group_relative_stds_sums = {}
+        self.label_group_relative_stds_with_num = {}
+        self.label_group_relative_stds_with_num_sums = {}
+        for i, col in enumerate(self.numeric_columns):
+            self.label_group_stds[col] = dict(zip(labels, stds[:, i].tolist()))
+            self.label_group_means[col] = dict(zip(labels, means[:, i].tolist()))
+            self.label_group_relative_stds[col] = dict(zip(labels, relative_stds[:, i].tolist()))
+            self.label_group_relative_stds_sums[col] = relative_stds[:, i].sum()
+            self.label_group_relative_stds_with_num[col] = dict(zip(labels, relative_stds_with_num[:, i].tolist()))
+            self.label_group_relative_stds_with_num_sums[col] = relative_stds_with_num[:, i].sum()
+
+    def read_data_chunks(self, param):
+        # chunks of the needed columns with the dtypes of the first pass, and the rows kept for training
+        header = 'infer' if param["header"] == 1 else None
+        reader = pd.read_csv(param["data"], delimiter=param["delimiter"], header=header, usecols=self.all_columns,
+                             dtype=self.ingest_dtypes, chunksize=param['ingest_chunk_rows'])
+        # both passes keep the same rows
+        rng = np.random.RandomState(self.ingest_seed)
+        for chunk in reader:
+            keep = None
+            if self.sample_for_train != 1:
+                keep = rng.random_sample(len(chunk)) < self.sample_for_train
+            chunk = chunk[self.all_columns]
+            if self.outlier_bounds is not None:
+                normal = self.outlier_masks(chunk)[0]
+                keep = normal if keep is None else keep & normal
+            yield chunk, keep
+
+    def estimate_outlier_bounds(self, param):
+        # the bounds of filter_outlier from a uniform sample of the table, exact up to OUTLIER_SAMPLE_ROWS rows
+        header = 'infer' if param["header"] == 1 else None
+        reader = pd.read_csv(param["data"], delimiter=param["delimiter"], header=header, usecols=self.numeric_columns,
+                             dtype={col: self.ingest_dtypes[col] for col in self.numeric_columns},
+                             chunksize=param['ingest_chunk_rows'])
+        reservoir = None
+        for chunk in reader:
+            sample = chunk[self.numeric_columns].assign(ingest_key=np.random.random_sample(len(chunk)))
+            reservoir = sample if reservoir is None else pd.concat([reservoir, sample])
+            reservoir = reservoir.nsmallest(OUTLIER_SAMPLE_ROWS, 'ingest_key')
+        bounds = 10 * reservoir[self.numeric_columns].quantile(0.99)
+        logger.info("outlier bounds:{}".format(bounds.to_dict()))
+        return bounds
+
+    def outlier_masks(self, chunk):
+        # normal rows are below the bound in every numeric column, outliers reach it in one of them, as in
+        # filter_outlier rows with missing values and no outlying value are neither
+        numeric_data = chunk[self.numeric_columns].values
+        bounds = self.outlier_bounds[self.numeric_columns].values
+        return (numeric_data < bounds).all(axis=1), (numeric_data >= bounds).any(axis=1)
+
+    def read_training_chunks(self, param, reduction):
+        """
+        reduction: None, or the label index, training rows and reduction quotas of every label group from
+            scan_data_chunked, the groups have the rows without a label in front
+        return: generator of the training rows of every chunk and their label data
+        """
+        if reduction is not None:
+            label_index, remaining_counts, remaining_quotas = reduction
+            remaining_counts = remaining_counts.copy()
+            remaining_quotas = remaining_quotas.copy()
+        for chunk, keep in self.read_data_chunks(param):
+            label_chunk = None
+            if self.label_column_name is not None:
+                label_chunk = self.generate_label_data(param['label_columns'], param['bucket_columns'], chunk)
+                if keep is not None:
+                    label_chunk = label_chunk[keep]
+            if keep is not None:
+                chunk = chunk[keep]
+            if reduction is not None:
+                # the rows of a group that fall in this chunk out of the rows of the group not read yet follow the
+                # hypergeometric distribution, so every group ends up with a uniform sample of exactly its quota
+                labels = label_chunk[self.label_column_name] if label_chunk is not None else \
+                    pd.Series(0, index=chunk.index)
+                codes = label_index.get_indexer(labels) + 1
+                chunk_counts = np.bincount(codes, minlength=len(remaining_counts))
+                quotas = np.zeros(len(chunk_counts), dtype=np.int64)
+                draw = (chunk_counts > 0) & (remaining_quotas > 0)
+                quotas[draw] = np.random.hypergeometric(chunk_counts[draw], remaining_counts[draw] - chunk_counts[draw],
+                                                        remaining_quotas[draw])
+                remaining_counts -= chunk_counts
+                remaining_quotas -= quotas
+                index = stratified_quota_index(codes, quotas)
+                chunk = chunk.iloc[index]
+                if label_chunk is not None:
+                    label_chunk = label_chunk.iloc[index]
+            yield chunk, label_chunk
+
+    def scan_data_chunked(self, param):
+        # first pass: label group counts and moments, categories, scaler ranges and the gaussian fitting reservoir
+        start_time = time.perf_counter()
+        self.name = param['name']
+        self.dataset_name = generate_dataset_name(param)
+        self.categorical_columns = param["categorical_columns"]
+        self.numeric_columns = param["numeric_columns"]
+        self.all_columns = self.numeric_columns + self.categorical_columns
+        self.all_categorical_columns = self.categorical_columns
+        self.label_column_name = None
+        self.outlier_bounds = None
+        label_flag = 'label_columns' in param and len(param['label_columns']) > 0
+        logger.info("loading data in chunks:{}".format(param["data"]))
+        # the dtypes found in the first chunk are used for the whole table, numeric columns that are not
+        # labels are read as float64 so that later chunks may hold missing or fractional values, the integer
+        # label and categorical columns as nullable integers so that later chunks may hold missing values
+        header = 'infer' if param["header"] == 1 else None
+        first_chunk = pd.read_csv(param["data"], delimiter=param["delimiter"], header=header,
+                                  usecols=self.all_columns, nrows=param['ingest_chunk_rows'])
+        label_columns = param['label_columns'] if label_flag else []
+        self.ingest_dtypes = {col: np.float64 if col in self.numeric_columns and col not in label_columns
+                              else 'Int64' if first_chunk[col].dtype.kind in 'iu'
+                              else first_chunk[col].dtype for col in self.all_columns}
+        self.ingest_seed = np.random.randint(2 ** 31 - 1)
+        if 'outliers' in param and param['outliers'] == 'true':
+            # one more pass over the numeric columns, the bounds decide which rows the other passes keep
+            self.outlier_bounds = self.estimate_outlier_bounds(param)
+        if self.numeric_encoding == 'gaussian':
+            self.gaussian_max_clusters = param["max_clusters"]
+            self.gmm_fit_processes = param['gmm_fit_processes'] if 'gmm_fit_processes' in param else 1
+            self.gmm_fit_sample_size = param['gmm_fit_sample_size'] if 'gmm_fit_sample_size' in param else None
+            reservoir_size = self.gmm_fit_sample_size if self.gmm_fit_sample_size is not None else 200000
+        else:
+            self.std_scaler = StandardScaler()
+            self.mm_scaler = MinMaxScaler()
+            range_scaler = MinMaxScaler()
+
+        total_rows = 0
+        self.total_rows = 0
+        label_group_counts = None
+        # training rows of every label value and without a label, a single group 0 without label columns
+        train_label_counts = None
+        train_missing_label_rows = 0
+        categories = {}
+        reservoir = None
+        outliers = []
+        for chunk, keep in self.read_data_chunks(param):
+            total_rows += len(chunk)
+            if self.outlier_bounds is not None:
+                outliers.append(chunk[self.outlier_masks(chunk)[1]])
+            if label_flag:
+                label_chunk = self.generate_label_data(param['label_columns'], param['bucket_columns'], chunk)
+                chunk_counts = label_chunk[self.label_column_name].value_counts()
+                label_group_counts = chunk_counts if label_group_counts is None else \
+                    label_group_counts.add(chunk_counts, fill_value=0)
+                self.group_moments = merge_group_moments(
+                    self.group_moments, group_moments(label_chunk, self.label_column_name, self.numeric_columns))
+                # the label encoder is fitted on the label values of every row of the table, as in encode_data
+                collect_categories(categories, self.label_column_name + '#label', label_chunk[self.label_column_name])
+                if keep is not None:
+                    label_chunk = label_chunk[keep]
+            if keep is not None:
+                chunk = chunk[keep]
+            self.total_rows += len(chunk)
+            labels = label_chunk[self.label_column_name] if label_flag else pd.Series(0, index=chunk.index)
+            chunk_counts = labels.value_counts()
+            train_label_counts = chunk_counts if train_label_counts is None else \
+                train_label_counts.add(chunk_counts, fill_value=0)
+            train_missing_label_rows += int(labels.isna().sum())
+            for col in self.all_categorical_columns:
+                collect_categories(categories, col, chunk[col])
+            if len(self.numeric_columns) > 0:
+                numeric_data = chunk[self.numeric_columns]
+                if self.numeric_encoding == 'gaussian':
+                    # the rows with the smallest random keys are a uniform sample of the rows seen so far, twice the
+                    # fit sample so that every group has its share in it, the smallest keys of every label group up
+                    # to an even share are kept too, so that the small groups can have their share of the fit sample
+                    sample = numeric_data.assign(ingest_key=np.random.random_sample(len(chunk)),
+                                                 ingest_label=labels.values)
+                    reservoir = sample if reservoir is None else pd.concat([reservoir, sample])
+                    group_cap = max(1, reservoir_size // (len(train_label_counts) + (train_missing_label_rows > 0)))
+                    group_codes = pd.factorize(reservoir['ingest_label'])[0]
+                    group_ranks = reservoir['ingest_key'].groupby(group_codes).rank(method='first').values
+                    ranks = reservoir['ingest_key'].rank(method='first').values
+                    reservoir = reservoir[(ranks <= 2 * reservoir_size) | (group_ranks <= group_cap)]
+                elif self.numeric_encoding == 'stdmm':
+                    self.std_scaler.partial_fit(numeric_data.values)
+                    range_scaler.partial_fit(numeric_data.values)
+                else:
+                    self.mm_scaler.partial_fit(numeric_data.values)
+        if self.numeric_encoding == 'stdmm' and len(self.numeric_columns) > 0:
+            # standardization keeps the order of the values, the standardized range is the one of the raw range
+            self.mm_scaler.fit(self.std_scaler.transform(np.vstack([range_scaler.data_min_, range_scaler.data_max_])))
+        if label_flag:
+            self.label_group_counts = label_group_counts.astype(np.int64).sort_values(ascending=False).to_dict()
+        if self.outlier_bounds is not None:
+            self.outliers = pd.concat(outliers)
+            self.outliers['{}_rate'.format(self.name)] = 1
+            logger.info("filtered outlier:{} rows".format(len(self.outliers)))
+        logger.info('data total rows:{}'.format(total_rows))
+        logger.info('data total rows after sample:{}'.format(self.total_rows))
+        self.train_rows = self.total_rows
+        label_index = train_label_counts.index
+        train_counts = np.concatenate([[train_missing_label_rows], train_label_counts.values]).astype(np.int64)
+        reduction = None
+        if 'train_reduction_rows' in param and self.total_rows > param['train_reduction_rows']:
+            # the quotas are taken in the encoding pass, the encoders are fitted on the rows before the reduction
+            allocation = senate_allocation(train_counts, param['train_reduction_rows'])
+            self.set_train_reduction(label_index, train_counts, allocation)
+            reduction = (label_index, train_counts, allocation)
+            train_counts = allocation
+            logger.info("sample the training data sample rows:{}".format(self.train_rows))
+        if reservoir is not None:
+            # the fit sample keeps the share of every label group in the training rows, as GaussianEncoder.fit does
+            quotas = train_counts if train_counts.sum() <= reservoir_size else \
+                stratified_quotas(train_counts, reservoir_size)
+            codes = label_index.get_indexer(reservoir['ingest_label']) + 1
+            ranks = reservoir['ingest_key'].groupby(codes).rank(method='first').values
+            reservoir = reservoir[ranks <= quotas[codes]]
+        end_time = time.perf_counter()
+        logger.info('load data time elapsed:{}'.format(end_time - start_time))
+        categories = {col: values.sort_values() for col, values in categories.items()}
+        return categories, reservoir, reduction
+
+    def encode_data_chunked(self, param):
+        # second pass: the encoded rows are streamed into .npy files next to the saved dataset
+        categories, reservoir, reduction = self.scan_data_chunked(param)
+        start_time = time.perf_counter()
+        categorical_digits = 0
+        if len(self.all_categorical_columns) > 0:
+            if self.categorical_encoding == 'binary':
+                self.bce = BinaryEncoder(cols=self.categorical_columns, label=None)
+                self.bce.fit_categories(categories)
+                self.column_digits = self.bce.column_digits
+                categorical_digits = sum(self.column_digits[col] for col in self.all_categorical_columns)
+            else:
+                first_row = pd.DataFrame({col: categories[col][:1] for col in self.all_categorical_columns})
+                self.encode_categorical_data_one_hot(first_row, [list(categories[col])
+                                                                 for col in self.all_categorical_columns])
+        if self.label_column_name is not None:
+            label_bce = BinaryEncoder(cols=[self.label_column_name], label=self.label_column_name)
+            label_bce.fit_categories({self.label_column_name: categories[self.label_column_name + '#label']})
+            self.label_value_mapping = label_bce.label_value_mapping
+            self.label_mapping_out = label_bce.mapping[self.label_column_name]
+        numeric_digits = 0
+        if len(self.numeric_columns) > 0:
+            if self.numeric_encoding == 'gaussian':
+                self.gme = GaussianEncoder(cols=self.numeric_columns, max_clusters=self.gaussian_max_clusters,
+                                           fit_processes=self.gmm_fit_processes)
+                self.gme.fit(reservoir[self.numeric_columns])
+                numeric_digits = self.gme.total_digits
+            else:
+                numeric_digits = len(self.numeric_columns)
+        end_time = time.perf_counter()
+        logger.info('fit encoders time elapsed:{}'.format(end_time - start_time))
+
+        start_time = time.perf_counter()
+        os.makedirs('./saved_datasets', exist_ok=True)
+        self.encoded_paths = {'data': './saved_datasets/{}_encoded.npy'.format(self.dataset_name)}
+        encoded_data = np.lib.format.open_memmap(self.encoded_paths['data'], mode='w+', dtype=np.float32,
+                                                 shape=(self.train_rows, numeric_digits + categorical_digits))
+        label_data = None
+        if self.label_column_name is not None:
+            self.encoded_paths['label'] = './saved_datasets/{}_label.npy'.format(self.dataset_name)
+            label_digits = label_bce.column_digits[self.label_column_name]
+            label_data = np.lib.format.open_memmap(self.encoded_paths['label'], mode='w+', dtype=np.float32,
+                                                   shape=(self.train_rows, label_digits))
+        onehot_indices = None
+        if self.categorical_encoding != 'binary' and len(self.all_categorical_columns) > 0:
+            self.encoded_paths['onehot'] = './saved_datasets/{}_onehot.npy'.format(self.dataset_name)
+            onehot_indices = np.lib.format.open_memmap(self.encoded_paths['onehot'], mode='w+', dtype=np.int32,
+                                                       shape=(self.train_rows, len(self.all_categorical_columns)))
+        st = 0
+        for chunk, label_chunk in self.read_training_chunks(param, reduction):
+            ed = st + len(chunk)
+            if len(self.numeric_columns) > 0:
+                numeric_block = encoded_data[st:ed, :numeric_digits]
+                if self.numeric_encoding == 'gaussian':
+                    self.encode_numeric_data_gaussian(chunk[self.numeric_columns], numeric_block)
+                else:
+                    self.encode_numeric_data_mm(chunk[self.numeric_columns], numeric_block)
+            if categorical_digits > 0:
+                self.encode_categorical_data_binary(chunk[self.all_categorical_columns], encoded_data[st:ed, numeric_digits:])
+            if onehot_indices is not None:
+                onehot_indices[st:ed] = self.encode_onehot_indices(chunk[self.all_categorical_columns])
+            if label_data is not None:
+                label_bce.transform_bits(label_chunk[[self.label_column_name]], label_data[st:ed])
+            st = ed
+        end_time = time.perf_counter()
+        logger.info('encode data in chunks time elapsed:{}'.format(end_time - start_time))
+
+        self.encoded_columns = []
+        if len(self.numeric_columns) > 0:
+            self.encoded_columns += self.gme.get_feature_names() if self.numeric_encoding == 'gaussian' \
+                else list(self.numeric_columns)
+        if categorical_digits > 0:
+            self.encoded_columns += self.bce.feature_names
+        self.label_encoded_columns = label_bce.feature_names if label_data is not None else None
+        for array in (encoded_data, label_data, onehot_indices):
+            if array is not None:
+                array.flush()
+        self.open_encoded_data(encoded_data, label_data, onehot_indices)
+        return encoded_data
+
+    def open_encoded_data(self, encoded_data=None, label_data=None, onehot_indices=None):
+        # the encoded arrays of a saved dataset or of the chunked ingest, mapped from their .npy files unless
+        # they are given, the pages are read on demand and shared by every process mapping the same files
+        if encoded_data is None:
+            encoded_data = np.load(self.encoded_paths['data'], mmap_mode='c')
+            if 'label' in self.encoded_paths:
+                label_data = np.load(self.encoded_paths['label'], mmap_mode='c')
+            if 'onehot' in self.encoded_paths:
+                onehot_indices = np.load(self.encoded_paths['onehot'], mmap_mode='c')
+        self.data = pd.DataFrame(encoded_data, columns=self.encoded_columns, copy=False)
+        self.feature_data = self.data
+        self.raw_data = torch.from_numpy(encoded_data).to(self.device)
+        if label_data is not None:
+            self.label = pd.DataFrame(label_data, columns=self.label_encoded_columns, copy=False)
+            self.raw_label_data = torch.from_numpy(label_data).to(self.device)
+        if onehot_indices is not None:
+            self.raw_onehot_indices = torch.from_numpy(onehot_indices).to(self.device)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if state.get('encoded_paths') is not None:
+            # the arrays stay in their .npy files, open_encoded_data maps them again
+            for key in ['data', 'feature_data', 'raw_data', 'raw_label_data', 'raw_onehot_indices']:
+                state[key] = None
+            if 'label' in state['encoded_paths']:
+                state['label'] = None
+            if 'origin' in state['encoded_paths']:
+                state['origin_df'] = None
+        # datasets loaded from older pickles still carry the label rows
+        state['label_df'] = None
+        return state
+
     def __getitem__(self, index):
+        # index is a single row or, with a BatchSampler, the rows of a whole mini-batch
         # return torch.from_numpy(self.raw_df[index, :])
         if self.inc_train_flag == 'inc_train':
             return self.inc_raw_data[index, :], self.inc_raw_label_data[index, :]
@@ -147,8 +500,24 @@ class TabularDataset(Dataset):
             return self.inc_sample_raw_data[index, :], self.inc_sample_raw_label_data[index, :]
         elif self.inc_train_flag == 'old_train':
             return self.inc_old_raw_data[index, :], self.inc_old_raw_label_data[index, :]
+        if getattr(self, 'raw_onehot_indices', None) is not None:
+            return self.densify_onehot(self.raw_data[index, :], self.raw_onehot_indices[index, :]), \
+                   self.raw_label_data[index, :]
         return self.raw_data[index, :], self.raw_label_data[index, :]
 
+    def densify_onehot(self, numeric_data, onehot_indices):
+        # float32 rows of the numeric block followed by the one-hot block of the given positions
+        squeeze = onehot_indices.dim() == 1
+        onehot_indices = onehot_indices.reshape(-1, onehot_indices.shape[-1]).long()
+        onehot_data = torch.zeros(len(onehot_indices), self.onehot_digits, device=onehot_indices.device)
+        # unseen values (-1) write a zero at the first position of their own column
+        known = onehot_indices >= 0
+        starts = torch.tensor(self.onehot_starts, device=onehot_indices.device).expand_as(onehot_indices)
+        onehot_data.scatter_(1, torch.where(known, onehot_indices, starts), known.float())
+        if squeeze:
+            onehot_data = onehot_data[0]
+        return torch.cat([numeric_data, onehot_data], dim=-1)
+
     def __len__(self):
         if self.inc_train_flag == 'inc_train':
             return self.inc_rows
@@ -156,7 +525,8 @@ class TabularDataset(Dataset):
             return self.inc_sample_rows
         elif self.inc_train_flag == 'old_train':
             return self.inc_old_rows
-        return self.total_rows
+        # datasets saved before train_rows train on all of their rows
+        return getattr(self, 'train_rows', self.total_rows)
 
     def load_incremental_data(self, train_config):
         start_time = time.perf_counter()
@@ -182,6 +552,11 @@ class TabularDataset(Dataset):
                     self.label_group_counts[label] += self.inc_label_group_counts[label]
                 else:
                     self.label_group_counts[label] = self.inc_label_group_counts[label]
+            if getattr(self, 'group_moments', None) is not None:
+                # the statistics of the old rows are merged with the new ones instead of being recomputed
+                self.group_moments = merge_group_moments(
+                    self.group_moments, group_moments(self.inc_df, self.label_column_name, self.numeric_columns))
+                self.update_label_group_stats()
         print("label group counts after:{}".format(self.label_group_counts))
         encoded_categorical = None
         encoded_numeric = None
@@ -191,8 +566,9 @@ class TabularDataset(Dataset):
             if self.categorical_encoding == 'binary':
                 encoded_categorical = self.bce.transform(categorical_data)
             else:
-                onehot_encoded = self.ohe.transform(categorical_data).todense()
-                encoded_categorical = pd.DataFrame(onehot_encoded, columns=self.onehot_encoded_columns)
+                onehot_indices = self.encode_onehot_indices(categorical_data)
+                encoded_categorical = pd.DataFrame(self.onehot_matrix(onehot_indices),
+                                                   columns=self.onehot_encoded_columns)
         end_cat_time = time.perf_counter()
         logger.info('encode incremental data categorical columns time elapsed:{}'.format(end_cat_time - start_cat_time))
 
@@ -230,7 +606,12 @@ class TabularDataset(Dataset):
         self.inc_raw_label_data = torch.from_numpy(self.inc_label.values.astype("float32")).to(self.device)
 
         ### strategy two: use all incremental data and old data to train
-        self.inc_old_data = pd.concat([self.inc_data, self.data], axis=0)
+        old_data = self.data
+        if getattr(self, 'raw_onehot_indices', None) is not None:
+            old_data = pd.concat([self.data.reset_index(drop=True),
+                                  pd.DataFrame(self.onehot_matrix(self.raw_onehot_indices.cpu().numpy()),
+                                               columns=self.onehot_encoded_columns)], axis=1)
+        self.inc_old_data = pd.concat([self.inc_data, old_data], axis=0)
         self.inc_old_rows = len(self.inc_old_data)
 
         if self.label_column_name is not None:
@@ -261,6 +642,36 @@ class TabularDataset(Dataset):
         end_time = time.perf_counter()
         logger.info('load incremental data time elapsed:{}'.format(end_time - start_time))
 
+    def reduce_training_data(self, total_sample):
+        """
+        senate sampling of the training rows: the groups smaller than an even share of total_sample are kept
+        whole, the larger ones share the remaining rows in proportion to their size
+        total_sample: rows kept for training
+        """
+        if self.label_column_name is not None:
+            labels = self.label_df[self.label_column_name].reindex(self.origin_df.index)
+        else:
+            labels = pd.Series(0, index=self.origin_df.index)
+        # rows without a label are a group of their own
+        codes, label_values = pd.factorize(labels)
+        codes = codes + 1
+        counts = np.bincount(codes, minlength=len(label_values) + 1)
+        allocation = senate_allocation(counts, total_sample)
+        self.origin_df = self.origin_df.iloc[stratified_quota_index(codes, allocation)]
+        self.set_train_reduction(label_values, counts, allocation)
+
+    def set_train_reduction(self, label_values, counts, allocation):
+        """
+        label_values: label of every group, counts and allocation have the rows without a label in front
+        counts: training rows of every group before the reduction
+        allocation: training rows kept of every group
+        """
+        # share of every group kept for training, total_rows keeps counting the table for the sample allocation
+        self.train_reduction_rates = dict(zip(label_values, (allocation[1:] / np.maximum(counts[1:], 1)).tolist()))
+        self.train_reduction_rate = allocation.sum() / self.total_rows
+        self.train_rows = int(allocation.sum())
+        logger.info("sample the training data allocation rate:{}".format(self.train_reduction_rates))
+
     def filter_outlier(self):
         numeric_data = self.origin_df[self.numeric_columns]
         # stds = numeric_data.std()
@@ -311,6 +722,7 @@ class TabularDataset(Dataset):
             # collect group count for each label group
             # self.label_group_counts = self.origin_df[self.label_column_name].value_counts().to_dict()
             self.label_group_counts = self.label_df[self.label_column_name].value_counts().to_dict()
+            self.group_moments = group_moments(self.label_df, self.label_column_name, self.numeric_columns)
         else:
             self.label_column_name = None
         if 'outliers' in param and param['outliers'] == 'true':
@@ -320,41 +732,19 @@ class TabularDataset(Dataset):
             self.origin_df = self.origin_df.sample(frac=self.sample_for_train)
             self.total_rows = len(self.origin_df)
             logger.info('data total rows after sample:{}'.format(self.total_rows))
+        # rows the model is trained on, fewer than total_rows with train_reduction_rows
+        self.train_rows = self.total_rows
         # logger.info('label value counts:{}'.format(self.label_group_counts))
-        if self.total_rows > 1000000:
-            rate = 0.5
-            if self.total_rows > 10000000:
-                rate = 0.01
-            # senate sampling
-            # total_sample=int(self.total_rows * rate)
-            # k = int( total_sample / len(self.label_group_counts))
-            # small_groups = {g: v for g, v in self.label_group_counts.items() if k >= v}
-            # big_groups = {g: v for g, v in self.label_group_counts.items() if k < v}
-            # allocated=sum(small_groups.values())
-            # sample_left=total_sample-allocated
-            # left=sum(big_groups.values())
-            # big_groups = {g: int(sample_left*v/left) for g, v in big_groups.items()}
-            # allocation={**small_groups,**big_groups}
-            # logger.info("sample the training data allocation:{}".format(allocation))
-            # rate = {g: allocation[g] / v for g, v in self.label_group_counts.items()}
-            # logger.info("sample the training data allocation rate:{}".format(rate))
-            # self.origin_df = self.origin_df.groupby(self.label_column_name).apply(
-            #     lambda x: x.sample(allocation[x.name]))
-            # self.origin_df.reset_index(drop=True, inplace=True)
-
-            # uniform sampling
-            # self.origin_df = self.origin_df.sample(frac=rate)
-
-            # self.total_rows = len(self.origin_df)
-
-            logger.info("sample the training data sample rows:{}".format(self.total_rows))
+        if 'train_reduction_rows' in param and self.total_rows > param['train_reduction_rows']:
+            self.reduce_training_data(param['train_reduction_rows'])
+            logger.info("sample the training data sample rows:{}".format(self.train_rows))
         # if self.label_column_name is not None and self.label_column_name not in self.categorical_columns:
         #     self.categorical_columns.append(self.label_column_name)
         end_time = time.perf_counter()
         logger.info('load data time elapsed:{}'.format(end_time - start_time))
 
-    def generate_label_data(self, label_columns,bucket_columns):
-        label_df=self.origin_df.copy()
+    def generate_label_data(self, label_columns,bucket_columns, df=None):
+        label_df=(self.origin_df if df is None else df).copy()
         label_columns_copy=label_columns.copy()
         if len(bucket_columns)>0:
             for col in bucket_columns:
@@ -375,35 +765,64 @@ class TabularDataset(Dataset):
             label_df[self.label_column_name] = label_df[label_columns_copy].astype(str).agg('-'.join, axis=1)
         return label_df
 
-    def encode_categorical_data_binary(self, categorical_data):
-        # binary encoding for categorical columns
+    def fit_categorical_data_binary(self, categorical_data):
+        # binary encoding for categorical columns, returns the number of bits
         self.bce = BinaryEncoder(cols=self.categorical_columns, label=None)
-        binary_encoded = self.bce.fit_transform(categorical_data)
+        self.bce.fit(categorical_data)
         self.column_digits = self.bce.column_digits
         # if self.label_column_name is not None:
         #     self.label_value_mapping = self.bce.label_value_mapping
         #     self.label_mapping_out = self.bce.mapping[self.label_column_name]
-        return binary_encoded
-
-    def encode_label_binary(self, label_data):
-        # binary encoding for categorical columns
+        return sum(self.column_digits[col] for col in self.all_categorical_columns)
+
+    def encode_categorical_data_binary(self, categorical_data, out):
+        # bits straight from the category codes into out, the layout gives each column's bit range
+        _, self.categorical_layout = self.bce.transform_bits(categorical_data, out)
+        return self.bce.feature_names
+
+    def encode_label_binary(self, label_data, index=None):
+        """
+        label_data: label column of every row of the table, the label values the encoder is fitted on
+        index: rows kept for training, the rows encoded, all rows if None
+        return: binary encoded label of the encoded rows
+        """
         bce = BinaryEncoder(cols=[self.label_column_name], label=self.label_column_name)
-        binary_encoded = bce.fit_transform(label_data)
+        bce.fit(label_data)
+        if index is not None and len(index) != len(label_data):
+            label_data = label_data.loc[index]
+        bits = np.empty((len(label_data), bce.column_digits[self.label_column_name]), dtype=np.float32)
+        bce.transform_bits(label_data, bits)
+        binary_encoded = pd.DataFrame(bits, columns=bce.feature_names, copy=False)
         # self.column_digits = self.bce.column_digits
         if self.label_column_name is not None:
             self.label_value_mapping = bce.label_value_mapping
             self.label_mapping_out = bce.mapping[self.label_column_name]
         return binary_encoded
 
+    def build_label_cache(self):
+        # condition row of every label code on the model device, ordered as label_value_mapping
+        label_matrix = self.label_mapping_out.loc[list(self.label_value_mapping.keys())].values.astype('float32')
+        self.label_cache = torch.from_numpy(label_matrix).to(self.device)
+        return self.label_cache
+
     def decode_categorical_data_binary(self, categorical_data):
         categorical_df = self.bce.inverse_transform(categorical_data)
         return categorical_df
 
-    def encode_numeric_data_gaussian(self, numeric_data):
+    def fit_numeric_data_gaussian(self, numeric_data):
         # numeric_data = self.origin_df[self.numeric_columns]
-        self.gme = GaussianEncoder(cols=self.numeric_columns, max_clusters=self.gaussian_max_clusters)
-        gaussian_encoded = self.gme.fit_transform(numeric_data)
-        return gaussian_encoded
+        self.gme = GaussianEncoder(cols=self.numeric_columns, max_clusters=self.gaussian_max_clusters,
+                                   fit_processes=self.gmm_fit_processes, fit_sample_size=self.gmm_fit_sample_size)
+        # the fit sample keeps the share of every label group
+        strata = None
+        if self.label_column_name is not None:
+            strata = self.label_df[self.label_column_name].reindex(numeric_data.index).values
+        self.gme.fit(numeric_data, strata)
+        return self.gme.total_digits
+
+    def encode_numeric_data_gaussian(self, numeric_data, out):
+        self.gme.transform(numeric_data, out)
+        return self.gme.get_feature_names()
 
     def decode_numeric_data_gaussian(self, numeric_data):
         numeric_df = self.gme.inverse_transform(numeric_data)
@@ -437,25 +856,116 @@ class TabularDataset(Dataset):
             sample_df = pd.concat([categorical_df, numeric_df], axis=1)
         return sample_df
 
-    def encode_numeric_data_mm(self, numeric_data):
+    def get_decode_plan(self, device):
+        # slices and denormalization tensors to decode raw decoder logits, built once per device
+        plan = getattr(self, 'decode_plan', None)
+        if plan is not None and plan['device'] == device:
+            return plan
+        numeric_plan = []
+        st = 0
+        if self.numeric_encoding == 'gaussian' and getattr(self.gme, 'component_offsets', None) is None:
+            self.gme.freeze_parameters()
+        for col in self.numeric_columns:
+            if self.numeric_encoding == 'gaussian':
+                idx = self.gme.cols.index(col)
+                component_st, component_ed = self.gme.component_offsets[idx], self.gme.component_offsets[idx + 1]
+                means = self.gme.means[component_st:component_ed]
+                stds = self.gme.stds[component_st:component_ed]
+                ed = st + 1 + component_ed - component_st
+                numeric_plan.append(('gaussian', st, ed,
+                                     torch.tensor(means, dtype=torch.float32, device=device),
+                                     torch.tensor(4 * stds, dtype=torch.float32, device=device)))
+            else:
+                # mm (and stdmm) decoding is an affine map of the normalized value
+                idx = self.numeric_columns.index(col)
+                scale = 1.0 / self.mm_scaler.scale_[idx]
+                shift = -self.mm_scaler.min_[idx] / self.mm_scaler.scale_[idx]
+                if self.numeric_encoding == 'stdmm':
+                    scale, shift = scale * self.std_scaler.scale_[idx], shift * self.std_scaler.scale_[idx] + \
+                                   self.std_scaler.mean_[idx]
+                ed = st + 1
+                numeric_plan.append(('affine', st, ed, float(scale), float(shift)))
+            st = ed
+        categorical_plan = []
+        categories = []
+        for idx, col in enumerate(self.categorical_columns):
+            ed = st + self.column_digits[col]
+            if self.categorical_encoding == 'binary':
+                digits = ed - st
+                powers = torch.tensor([2 ** (digits - 1 - i) for i in range(digits)], dtype=torch.int32, device=device)
+                categorical_plan.append(('binary', st, ed, powers))
+                categories.append(np.array(list(self.bce.column_categories_map[col].values())))
+            else:
+                categorical_plan.append(('onehot', st, ed, None))
+                categories.append(np.asarray(self.ohe.categories_[idx]))
+            st = ed
+        plan = {'device': device, 'numeric': numeric_plan, 'categorical': categorical_plan, 'categories': categories}
+        self.decode_plan = plan
+        return plan
+
+    def decode_logits(self, logits):
+        # decode raw logits into int32 category codes and float32 numeric values without leaving torch
+        plan = self.get_decode_plan(logits.device)
+        n = logits.size(0)
+        codes = torch.empty(n, len(plan['categorical']), dtype=torch.int32, device=logits.device)
+        values = torch.empty(n, len(plan['numeric']), dtype=torch.float32, device=logits.device)
+        for i, (kind, st, ed, a, b) in enumerate(plan['numeric']):
+            if kind == 'gaussian':
+                component = torch.argmax(logits[:, st + 1:ed], dim=1)
+                values[:, i] = logits[:, st].clamp(-1, 1) * b[component] + a[component]
+            else:
+                values[:, i] = logits[:, st] * a + b
+        for i, (kind, st, ed, powers) in enumerate(plan['categorical']):
+            if kind == 'binary':
+                # sigmoid(x) >= 0.5 is x >= 0, the bits are packed into the category code
+                codes[:, i] = ((logits[:, st:ed] >= 0).int() * powers).sum(dim=1)
+            else:
+                codes[:, i] = torch.argmax(logits[:, st:ed], dim=1)
+        return codes, values
+
+    def decode_compact_samples(self, codes, values):
+        # map category codes to their values, codes outside the category range become NaN
+        plan = getattr(self, 'decode_plan', None) or self.get_decode_plan(self.device)
+        columns = {}
+        for i, col in enumerate(self.categorical_columns):
+            categories = plan['categories'][i]
+            col_codes = codes[:, i]
+            invalid = col_codes >= len(categories)
+            col_values = np.take(categories, np.minimum(col_codes, len(categories) - 1))
+            if invalid.any():
+                col_values = col_values.astype(float if col_values.dtype.kind in 'iub' else object)
+                col_values[invalid] = np.nan
+            columns[col] = col_values
+        for i, col in enumerate(self.numeric_columns):
+            columns[col] = values[:, i]
+        return pd.DataFrame(columns)
+
+    def fit_numeric_data_mm(self, numeric_data):
         self.std_scaler = StandardScaler()
         self.mm_scaler = MinMaxScaler()
 
-        numeric_data = np.array(numeric_data)
+        numeric_data = np.asarray(numeric_data)
         # numeric_data = self.std_scaler.fit_transform(numeric_data)
-        numeric_data = self.mm_scaler.fit_transform(numeric_data)
-        numeric_data = pd.DataFrame(numeric_data, columns=self.numeric_columns)
-        return numeric_data
+        self.mm_scaler.fit(numeric_data)
+        return len(self.numeric_columns)
 
-    def encode_numeric_data_stdmm(self, numeric_data):
+    def fit_numeric_data_stdmm(self, numeric_data):
         self.std_scaler = StandardScaler()
         self.mm_scaler = MinMaxScaler()
 
-        numeric_data = np.array(numeric_data)
-        numeric_data = self.std_scaler.fit_transform(numeric_data)
-        numeric_data = self.mm_scaler.fit_transform(numeric_data)
-        numeric_data = pd.DataFrame(numeric_data, columns=self.numeric_columns)
-        return numeric_data
+        numeric_data = np.asarray(numeric_data)
+        self.mm_scaler.fit(self.std_scaler.fit_transform(numeric_data))
+        return len(self.numeric_columns)
+
+    def encode_numeric_data_mm(self, numeric_data, out, chunk_size=1000000):
+        # mm and stdmm scaling chunk by chunk into out, the float64 intermediates stay chunk sized
+        numeric_data = np.asarray(numeric_data)
+        for st in range(0, len(numeric_data), chunk_size):
+            chunk = numeric_data[st:st + chunk_size]
+            if self.numeric_encoding == 'stdmm':
+                chunk = self.std_scaler.transform(chunk)
+            out[st:st + chunk_size] = self.mm_scaler.transform(chunk)
+        return list(self.numeric_columns)
 
     def decode_numeric_data_mm(self, numeric_data):
         numeric_data = self.mm_scaler.inverse_transform(numeric_data)
@@ -469,23 +979,39 @@ class TabularDataset(Dataset):
         numeric_df = pd.DataFrame(numeric_data, columns=self.numeric_columns)
         return numeric_df
 
-    def encode_categorical_data_one_hot(self, categorical_data):
+    def encode_categorical_data_one_hot(self, categorical_data, categories='auto'):
         # categorical_data = self.origin_df[all_categorical_columns]
         # one hot encoding for categorical columns
-        self.ohe = OneHotEncoder(handle_unknown='ignore')
-        onehot_encoded = self.ohe.fit_transform(categorical_data).todense()
+        self.ohe = OneHotEncoder(categories=categories, handle_unknown='ignore')
+        self.ohe.fit(categorical_data)
 
         self.column_digits = {}
         self.onehot_encoded_columns = []
+        self.onehot_starts = []
         categories = self.ohe.categories_
         for idx, col in enumerate(self.all_categorical_columns):
             self.column_digits[col] = len(categories[idx])
             if self.label_column_name is not None and self.label_column_name == col:
                 self.label_value_mapping = dict(enumerate(categories[idx]))
+            self.onehot_starts.append(len(self.onehot_encoded_columns))
             self.onehot_encoded_columns += [col + str(i) for i in range(len(categories[idx]))]
+        self.onehot_digits = len(self.onehot_encoded_columns)
+        return self.encode_onehot_indices(categorical_data)
 
-        onehot_encoded = pd.DataFrame(onehot_encoded, columns=self.onehot_encoded_columns)
-        return onehot_encoded
+    def encode_onehot_indices(self, categorical_data):
+        # position of every value in the one-hot block, -1 for values the encoder has not seen
+        onehot_indices = np.empty((len(categorical_data), len(self.all_categorical_columns)), dtype=np.int32)
+        for idx, col in enumerate(self.all_categorical_columns):
+            codes = pd.Categorical(categorical_data[col], categories=self.ohe.categories_[idx]).codes
+            onehot_indices[:, idx] = np.where(codes >= 0, codes + self.onehot_starts[idx], -1)
+        return onehot_indices
+
+    def onehot_matrix(self, onehot_indices):
+        # dense uint8 one-hot block of the given positions
+        onehot_data = np.zeros((len(onehot_indices), self.onehot_digits), dtype=np.uint8)
+        rows, cols = np.nonzero(onehot_indices >= 0)
+        onehot_data[rows, onehot_indices[rows, cols]] = 1
+        return onehot_data
 
     def decode_categorical_data_one_hot(self, categorical_data):
         categorical_data = self.ohe.inverse_transform(categorical_data)
@@ -499,9 +1025,65 @@ class TabularDataset(Dataset):
                 self.raw_data = self.raw_data.to(self.device)
             if self.raw_label_data != None:
                 self.raw_label_data = self.raw_label_data.to(self.device)
+            if getattr(self, 'raw_onehot_indices', None) is not None:
+                self.raw_onehot_indices = self.raw_onehot_indices.to(self.device)
+            if getattr(self, 'label_cache', None) is not None:
+                self.label_cache = self.label_cache.to(self.device)
             print('device is changed to No.{} gpu'.format(self.device))
 
 
+def collect_categories(categories, col, values):
+    # distinct non missing values of a column, merged chunk by chunk
+    values = pd.Index(pd.unique(values.dropna()))
+    categories[col] = values if col not in categories else categories[col].append(values).unique()
+
+
+def group_moments(df, label_column_name, columns):
+    """
+    df: rows with the label column and the numeric columns
+    return: GroupMoments, count, mean and M2 (sum of squared deviations from the mean) of all columns for every
+        label group, from bincounts over the label codes
+    """
+    codes, labels = pd.factorize(df[label_column_name], sort=True)
+    # rows without a label are in no group, as in groupby
+    valid = codes >= 0
+    codes = codes[valid]
+    values = np.asarray(df[columns].values[valid], dtype=np.float64)
+    present = ~np.isnan(values)
+    values = np.where(present, values, 0)
+    # one flat bin per (group, column)
+    shape = (len(labels), len(columns))
+    bins = (codes.reshape([-1, 1]) * len(columns) + np.arange(len(columns))).reshape([-1])
+    counts = np.bincount(bins, weights=present.reshape([-1]), minlength=shape[0] * shape[1]).reshape(shape)
+    sums = np.bincount(bins, weights=values.reshape([-1]), minlength=shape[0] * shape[1]).reshape(shape)
+    means = np.divide(sums, counts, out=np.zeros(shape), where=counts > 0)
+    deviations = np.where(present, values - means[codes], 0)
+    m2 = np.bincount(bins, weights=(deviations ** 2).reshape([-1]), minlength=shape[0] * shape[1]).reshape(shape)
+    return GroupMoments(labels=pd.Index(labels), counts=counts, means=means, m2=m2)
+
+
+def merge_group_moments(a, b):
+    # Chan et al. pairwise update of count, mean and M2, a group missing on one side comes from the other
+    if a is None:
+        return b
+    labels = a.labels.union(b.labels)
+    shape = (len(labels), a.counts.shape[1])
+    merged = []
+    for moments in (a, b):
+        idx = labels.get_indexer(moments.labels)
+        expanded = [np.zeros(shape), np.zeros(shape), np.zeros(shape)]
+        for array, values in zip(expanded, (moments.counts, moments.means, moments.m2)):
+            array[idx] = values
+        merged.append(expanded)
+    (count_a, mean_a, m2_a), (count_b, mean_b, m2_b) = merged
+    counts = count_a + count_b
+    weight_b = np.divide(count_b, counts, out=np.zeros(shape), where=counts > 0)
+    delta = mean_b - mean_a
+    means = mean_a + delta * weight_b
+    m2 = m2_a + m2_b + delta ** 2 * count_a * weight_b
+    return GroupMoments(labels=labels, counts=counts, means=means, m2=m2)
+
+
 def generate_dataset_name(train_config):
     dataset_name = 'dataset'
     if train_config["model_type"] == "keras_vae" or train_config["model_type"] == "torch_vae":
@@ -522,23 +1104,100 @@ def generate_dataset_name(train_config):
                                                      train_config["numeric_encoding"] == 'gaussian' else
                                                      train_config["numeric_encoding"],
                                                      train_config['gpu_num'], )
+    # options that change the encoded rows or the fitted encoders, a dataset saved with other options is not reused
+    # they only show up when set, so the names of datasets saved without them stay the same
+    if 'train_reduction_rows' in train_config:
+        dataset_name += "_tr{}".format(train_config['train_reduction_rows'])
+    if 'ingest_chunk_rows' in train_config:
+        dataset_name += "_ic{}".format(train_config['ingest_chunk_rows'])
+    if train_config["numeric_encoding"] == 'gaussian':
+        if 'gmm_fit_sample_size' in train_config:
+            dataset_name += "_gs{}".format(train_config['gmm_fit_sample_size'])
+        if 'gmm_fit_processes' in train_config and train_config['gmm_fit_processes'] > 1:
+            dataset_name += "_gp{}".format(train_config['gmm_fit_processes'])
     return dataset_name
 
 
+def save_array(array, path):
+    # written next to the target and renamed, processes still mapping the old file keep their pages
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        np.save(file, array)
+    os.replace(tmp_path, path)
+
+
+def read_dataset_meta(dataset_name):
+    path = "./saved_datasets/{}.json".format(dataset_name)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as file:
+        meta = json.load(file)
+    if meta['format_version'] != DATASET_FORMAT_VERSION:
+        raise ValueError("dataset {} has format version {}, expected {}".format(
+            dataset_name, meta['format_version'], DATASET_FORMAT_VERSION))
+    return meta
+
+
 def save_dataset(dataset, param, postfix=''):
+    """
+    saved_datasets/<dataset>: the dataset without its data, i.e. the fitted encoders and the label statistics
+    saved_datasets/<dataset>_encoded.npy, _label.npy, _onehot.npy: the encoded matrix, the label bits and the
+        one-hot indices, memory mapped by load_dataset
+    saved_datasets/<dataset>_origin.pkl: the raw table, read only by the non aqp operations
+    saved_datasets/<dataset>.json: format version, shapes and columns, written last
+    """
     dataset_name = dataset.dataset_name  # generate_dataset_name(param)
     dataset_name += postfix
+    arrays = {'data': dataset.raw_data, 'label': dataset.raw_label_data,
+              'onehot': getattr(dataset, 'raw_onehot_indices', None)}
+    old_paths = getattr(dataset, 'encoded_paths', None) or {}
+    encoded_paths = {}
+    for key, array in list(arrays.items()):
+        if array is None:
+            del arrays[key]
+            continue
+        arrays[key] = array = array.cpu().numpy()
+        path = "./saved_datasets/{}_{}.npy".format(dataset_name, 'encoded' if key == 'data' else key)
+        # the chunked ingest already wrote its arrays there
+        if old_paths.get(key) != path:
+            save_array(array, path)
+        encoded_paths[key] = path
+    if getattr(dataset, 'origin_df', None) is not None:
+        encoded_paths['origin'] = "./saved_datasets/{}_origin.pkl".format(dataset_name)
+        dataset.origin_df.to_pickle(encoded_paths['origin'])
+    elif 'origin' in old_paths:
+        encoded_paths['origin'] = old_paths['origin']
+    dataset.encoded_columns = list(dataset.data.columns)
+    dataset.label_encoded_columns = list(dataset.label.columns)
+    dataset.encoded_paths = encoded_paths
+
     path = "./saved_datasets/{}".format(dataset_name)
     with open(path, 'wb') as file:
         pickle.dump(dataset, file, True)
-
-    dataset.data = None
-    dataset.raw_data = None
-    dataset.raw_label_data = None
+    meta = {'format_version': DATASET_FORMAT_VERSION, 'dataset_name': dataset_name, 'rows': len(dataset.raw_data),
+            'data_dim': dataset.data_dim, 'label_column_name': dataset.label_column_name,
+            'encoded_columns': dataset.encoded_columns, 'label_encoded_columns': dataset.label_encoded_columns,
+            'arrays': {key: {'path': path, 'dtype': str(arrays[key].dtype), 'shape': list(arrays[key].shape)}
+                       for key, path in encoded_paths.items() if key in arrays},
+            'origin': encoded_paths.get('origin')}
+    with open("./saved_datasets/{}.json".format(dataset_name), 'w') as file:
+        json.dump(meta, file, indent=2, default=str)
+    # the in memory arrays are released for their mapped files
     dataset.origin_df = None
-    light_path = "./saved_datasets/{}_light".format(dataset_name)
-    with open(light_path, 'wb') as file:
-        pickle.dump(dataset, file, True)
+    dataset.open_encoded_data()
+
+
+def load_origin_data(train_config, postfix=''):
+    # the raw table of a saved dataset, without loading the encoded data
+    dataset_name = generate_dataset_name(train_config) + postfix
+    meta = read_dataset_meta(dataset_name)
+    if meta is None:
+        return load_dataset(train_config, postfix).origin_df
+    if meta['origin'] is None:
+        # the chunked ingest is for tables larger than memory, it keeps no raw table to load here
+        raise ValueError("dataset {} was ingested in chunks (ingest_chunk_rows) and has no raw table, "
+                         "only the aqp operation is supported".format(dataset_name))
+    return pd.read_pickle(meta['origin'])
 
 
 def load_dataset(train_config, postfix=''):
@@ -546,11 +1205,15 @@ def load_dataset(train_config, postfix=''):
     dataset_name = generate_dataset_name(train_config)
     dataset_name += postfix
     logger.info("load existing dataset:{}".format(dataset_name))
+    read_dataset_meta(dataset_name)
     path = "./saved_datasets/{}".format(dataset_name)
     with open(path, 'rb') as file:
         dataset = pickle.load(file)
     gpu_num = train_config['gpu_num']
     device = torch.device("cuda:{}".format(gpu_num) if torch.cuda.is_available() else "cpu")
+    # datasets saved before the .npy artifacts carry their data in the pickle
+    if getattr(dataset, 'encoded_paths', None) is not None:
+        dataset.open_encoded_data()
     dataset.change_device(device)
     if "inc_data" in train_config and train_config['inc_train_flag'] != 'origin_train':
         dataset.inc_train_flag = train_config['inc_train_flag']
@@ -566,6 +1229,9 @@ def load_light_dataset(train_config, postfix=''):
     dataset_name += postfix
     logger.info("load existing dataset(light):{}".format(dataset_name))
     path = "./saved_datasets/{}_light".format(dataset_name)
+    if read_dataset_meta(dataset_name) is not None:
+        # the saved dataset holds no data, it is the light dataset
+        path = "./saved_datasets/{}".format(dataset_name)
     if os.path.isfile(path):
         with open(path, 'rb') as file:
             dataset = pickle.load(file)
@@ -0,0 +1,85 @@
+import logging
+import os
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutionContext:
+    """CPU threads of torch and numexpr, and the cores of each concurrent sampling replicate."""
+    def __init__(self, query_config):
+        if hasattr(os, 'sched_getaffinity'):
+            self.cores = sorted(os.sched_getaffinity(0))
+        else:
+            self.cores = list(range(os.cpu_count()))
+        self.num_threads = query_config['num_threads'] if 'num_threads' in query_config else len(self.cores)
+        self.interop_threads = query_config['interop_threads'] if 'interop_threads' in query_config else None
+        self.replicates = max(1, query_config['multi_sample_times'] if 'multi_sample_times' in query_config else 1)
+        self.pin_cores = 'pin_cores' in query_config and query_config['pin_cores'] == 'true'
+        # 'thread' runs the replicates in threads, 'process' opts in to forked worker processes where possible
+        self.replicate_executor = query_config['replicate_executor'] if 'replicate_executor' in query_config \
+            else 'thread'
+        self.applied = False
+
+    def apply(self):
+        # whole process settings, used as they are for training and single replicate queries
+        if self.applied:
+            return
+        self.applied = True
+        self.set_threads(self.num_threads)
+        if self.interop_threads is not None:
+            try:
+                torch.set_num_interop_threads(self.interop_threads)
+            except RuntimeError as e:
+                # torch only accepts it before the first inter-op parallel work
+                logger.warning("inter-op threads not set:{}".format(e))
+        logger.info("execution context: cores:{} threads:{} inter-op threads:{} replicates:{}".format(
+            len(self.cores), self.num_threads, torch.get_num_interop_threads(), self.replicates))
+
+    def set_threads(self, num_threads):
+        torch.set_num_threads(num_threads)
+        if numexpr is not None:
+            numexpr.set_num_threads(num_threads)
+
+    def get_threads(self):
+        return torch.get_num_threads(), numexpr.get_num_threads() if numexpr is not None else None
+
+    def restore_threads(self, previous):
+        torch_threads, numexpr_threads = previous
+        torch.set_num_threads(torch_threads)
+        if numexpr_threads is not None:
+            numexpr.set_num_threads(numexpr_threads)
+
+    def replicate_threads(self):
+        return max(1, self.num_threads // self.replicates)
+
+    def core_partition(self, replicate_id):
+        if len(self.cores) < self.replicates:
+            # more replicates than cores, the replicates share the cores one by one
+            return [self.cores[replicate_id % len(self.cores)]]
+        partitions = np.array_split(np.array(self.cores), self.replicates)
+        return [int(core) for core in partitions[replicate_id % self.replicates]]
+
+    @contextmanager
+    def replicates_scope(self):
+        # the replicates share the threads instead of each of them using all of the cores
+        previous = self.get_threads()
+        try:
+            self.set_threads(self.replicate_threads())
+            yield self
+        finally:
+            # back to the thread counts from before the scope, whatever they were
+            self.restore_threads(previous)
+
+    def pin_replicate(self, replicate_id):
+        # pins the calling thread (or process) to the cores of its replicate
+        if self.pin_cores and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.core_partition(replicate_id))
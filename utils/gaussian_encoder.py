@@ -3,107 +3,172 @@
 import pandas as pd
 import numpy as np
 import math
+import multiprocessing
 import re
 from collections import namedtuple
 
 from sklearn.mixture import BayesianGaussianMixture
 
+from utils.stratified_sampling import stratified_sample_index
+
 GaussianModel = namedtuple(
     "GaussianModel", ["gm", "valid", "num_components"])
 
 
+def fit_gaussian_model(column_data, max_clusters, weight_threshold, random_state=None):
+    gm = BayesianGaussianMixture(
+        n_components=max_clusters,
+        weight_concentration_prior_type='dirichlet_process',
+        weight_concentration_prior=0.001,
+        n_init=1,
+        random_state=random_state
+    )
+    gm.fit(column_data.reshape(-1, 1))
+    valid_component_indicator = gm.weights_ > weight_threshold
+    num_components = valid_component_indicator.sum()
+    return GaussianModel(gm=gm, valid=valid_component_indicator, num_components=num_components)
+
+
+def fit_gaussian_model_task(task):
+    return fit_gaussian_model(*task)
+
+
 class GaussianEncoder():
-    def __init__(self, cols, max_clusters=10, weight_threshold=0.001):
+    def __init__(self, cols, max_clusters=10, weight_threshold=0.001, chunk_size=1000000, fit_processes=1,
+                 fit_sample_size=None):
         self.cols = cols
         self.max_clusters = max_clusters
         self.weight_threshold = weight_threshold
-
-    def fit(self, df):
+        # rows encoded at a time, bounds the component probability matrices of transform
+        self.chunk_size = chunk_size
+        # columns fitted concurrently in worker processes
+        self.fit_processes = fit_processes
+        # rows of the stratified sample every mixture is fitted on, None fits on the whole column
+        self.fit_sample_size = fit_sample_size
+
+    def fit(self, df, strata=None):
+        """
+        df: numeric columns to fit
+        strata: optional stratum (e.g. label) of every row of df, keeps the fit sample stratified
+        """
         self.gms = {}
         self.total_digits=0
+        if self.fit_sample_size is not None and self.fit_sample_size < len(df):
+            df = df.iloc[stratified_sample_index(len(df), self.fit_sample_size, strata)]
+        if self.fit_processes > 1 and len(self.cols) > 1:
+            # the workers get their random states from the parent, so the fit follows np.random.seed
+            tasks = [(df[col].values, self.max_clusters, self.weight_threshold, np.random.randint(2 ** 31 - 1))
+                     for col in self.cols]
+            processes = min(self.fit_processes, len(self.cols))
+            with multiprocessing.Pool(processes) as pool:
+                gaussian_models = pool.map(fit_gaussian_model_task, tasks)
+        else:
+            gaussian_models = [fit_gaussian_model(df[col].values, self.max_clusters, self.weight_threshold)
+                               for col in self.cols]
+        for col, gaussian_model in zip(self.cols, gaussian_models):
+            self.total_digits+=gaussian_model.num_components+1
+            self.gms[col] = gaussian_model
+        self.freeze_parameters()
+
+    def freeze_parameters(self):
+        # valid component means and stds of all columns in flat arrays, column i owns the components
+        # component_offsets[i]:component_offsets[i + 1] and its encoded block starts at column_offsets[i]
+        means = []
+        stds = []
+        num_components = []
         for col in self.cols:
-            column_data = df[col].values
-            gm = BayesianGaussianMixture(
-                n_components=self.max_clusters,
-                weight_concentration_prior_type='dirichlet_process',
-                weight_concentration_prior=0.001,
-                n_init=1
-            )
-            gm.fit(column_data.reshape(-1, 1))
-            valid_component_indicator = gm.weights_ > self.weight_threshold
-            num_components = valid_component_indicator.sum()
-            self.total_digits+=num_components+1
-            self.gms[col] = GaussianModel(gm=gm, valid=valid_component_indicator, num_components=num_components)
-
-    def transform(self, data):
-        column_data_list = []
+            gm, valid, _ = self.gms[col]
+            means.append(gm.means_.reshape([-1])[valid])
+            stds.append(np.sqrt(gm.covariances_).reshape([-1])[valid])
+            num_components.append(int(valid.sum()))
+        self.means = np.concatenate(means) if len(means) > 0 else np.zeros(0)
+        self.stds = np.concatenate(stds) if len(stds) > 0 else np.zeros(0)
+        self.component_offsets = np.concatenate([[0], np.cumsum(num_components)]).astype(np.int64)
+        self.column_offsets = self.component_offsets[:-1] + np.arange(len(self.cols))
+
+    @staticmethod
+    def sample_components(component_probs):
+        """
+        component_probs: (n, num_components) component probabilities of every row
+        return: one component per row, drawn from its smoothed probabilities
+        """
+        # np.random.choice with p, for all rows at once: one uniform per row against the normalized cdf
+        component_probs = component_probs + 1e-6
+        component_probs = component_probs / component_probs.sum(axis=1, keepdims=True)
+        cdf = np.cumsum(component_probs, axis=1)
+        cdf /= cdf[:, -1:]
+        uniform_samples = np.random.random_sample(len(component_probs))
+        return (cdf <= uniform_samples.reshape([-1, 1])).sum(axis=1)
+
+    def get_feature_names(self):
         column_names = []
         for col in self.cols:
+            column_names.append(col + "_norm")
+            column_names += [col + "_" + str(i) for i in range(self.gms[col].num_components)]
+        return column_names
+
+    def transform(self, data, out=None):
+        """
+        data: DataFrame with the numeric columns
+        out: optional preallocated (n, total_digits) array the encoding is written to, e.g. a block of the
+            training matrix
+        return: out, or a float64 DataFrame when out is not given
+        """
+        if getattr(self, 'component_offsets', None) is None:
+            self.freeze_parameters()
+        encoded_data = out if out is not None else np.empty((len(data), self.total_digits))
+        chunk_size = getattr(self, 'chunk_size', 1000000)
+        for i, col in enumerate(self.cols):
             column_data = data[[col]].values
             gm = self.gms[col].gm
             valid_component_indicator = self.gms[col].valid
             num_components = valid_component_indicator.sum()
             means = gm.means_.reshape((1, self.max_clusters))
             stds = np.sqrt(gm.covariances_).reshape((1, self.max_clusters))
-            normalized_values = ((column_data - means) / (4 * stds))[:, valid_component_indicator]
-            component_probs = gm.predict_proba(column_data)[:, valid_component_indicator]
-            selected_component = np.zeros(len(column_data), dtype='int')
-            for i in range(len(column_data)):
-                component_porb_t = component_probs[i] + 1e-6
-                component_porb_t = component_porb_t / component_porb_t.sum()
-                selected_component[i] = np.random.choice(
-                    np.arange(num_components), p=component_porb_t)
-            selected_normalized_value = normalized_values[
-                np.arange(len(column_data)), selected_component].reshape([-1, 1])
-            selected_normalized_value = np.clip(selected_normalized_value, -.99, .99)
-
-            selected_component_onehot = np.zeros_like(component_probs)
-            selected_component_onehot[np.arange(len(column_data)), selected_component] = 1
-            column_data_list.append(selected_normalized_value)
-            column_data_list.append(selected_component_onehot)
-            column_names.append(col + "_norm")
-            column_names += [col + "_" + str(i) for i in range(num_components)]
-        encoded_data = np.concatenate(column_data_list, axis=1).astype(float)
-        return pd.DataFrame(encoded_data, columns=column_names)
+            # normalized value followed by the one-hot selected component
+            norm_idx = self.column_offsets[i]
+            selected_component_onehot = encoded_data[:, norm_idx + 1:norm_idx + 1 + num_components]
+            for st in range(0, len(column_data), chunk_size):
+                chunk = column_data[st:st + chunk_size]
+                rows = np.arange(len(chunk))
+                normalized_values = ((chunk - means) / (4 * stds))[:, valid_component_indicator]
+                component_probs = gm.predict_proba(chunk)[:, valid_component_indicator]
+                selected_component = self.sample_components(component_probs)
+                encoded_data[st:st + chunk_size, norm_idx] = np.clip(normalized_values[rows, selected_component],
+                                                                     -.99, .99)
+                onehot = np.zeros_like(component_probs)
+                onehot[rows, selected_component] = 1
+                selected_component_onehot[st:st + chunk_size] = onehot
+        if out is not None:
+            return out
+        return pd.DataFrame(encoded_data, columns=self.get_feature_names())
 
     def inverse_transform(self, data, sigmas=None):
-        st = 0
-        recovered_column_data_list = []
-        column_names = []
-        for col in self.cols:
-            gm = self.gms[col].gm
-            valid_component_indicator = self.gms[col].valid
-            dim = self.gms[col].num_components + 1
-            column_data = data[:, st:st + dim]
-            selected_normalized_value = column_data[:, 0]
-            selected_component_probs = column_data[:, 1:]
-            if sigmas is not None:
-                sig = sigmas[st]
-                selected_normalized_value = np.random.normal(selected_normalized_value, sig)
-
-            selected_normalized_value = np.clip(selected_normalized_value, -1, 1)#.astype(np.float32)
-            component_probs = np.ones((len(column_data), self.max_clusters)) * -100
-            component_probs[:, valid_component_indicator] = selected_component_probs
-
-            means = gm.means_.reshape([-1])
-            stds = np.sqrt(gm.covariances_).reshape([-1])
-            selected_component = np.argmax(component_probs, axis=1)
-
-            std_t = stds[selected_component]
-            mean_t = means[selected_component]
-            recovered_column_data = selected_normalized_value * 4 * std_t + mean_t
-
-            recovered_column_data_list.append(recovered_column_data)
-            column_names.append(col)
-            st += dim
-
-        recovered_data = np.column_stack(recovered_column_data_list)
-        recovered_data = (pd.DataFrame(recovered_data, columns=column_names))
-
-        return recovered_data
-
-    def fit_transform(self, data):
-        self.fit(data)
+        if getattr(self, 'component_offsets', None) is None:
+            # encoders fitted before the parameters were frozen
+            self.freeze_parameters()
+        n = len(data)
+        selected_normalized_value = data[:, self.column_offsets]
+        if sigmas is not None:
+            # drawn column by column, in the same order as before
+            sig = np.asarray(sigmas)[self.column_offsets]
+            selected_normalized_value = np.random.normal(selected_normalized_value.T, sig.reshape([-1, 1])).T
+        selected_normalized_value = np.clip(selected_normalized_value, -1, 1)
+
+        # most likely valid component of every column, as an index into the flat parameter arrays
+        selected_component = np.empty((n, len(self.cols)), dtype=np.int64)
+        for i in range(len(self.cols)):
+            st = self.column_offsets[i] + 1
+            ed = st + self.component_offsets[i + 1] - self.component_offsets[i]
+            np.argmax(data[:, st:ed], axis=1, out=selected_component[:, i])
+        selected_component += self.component_offsets[:-1]
+
+        recovered_data = selected_normalized_value * 4 * self.stds[selected_component] + \
+            self.means[selected_component]
+        return pd.DataFrame(recovered_data, columns=list(self.cols))
+
+    def fit_transform(self, data, strata=None):
+        self.fit(data, strata)
         return self.transform(data)
 
 
@@ -1,7 +1,7 @@
 import json
 from random import sample, seed
 import pandas as pd
-from models.pytorch_cvae import generate_group_samples, generate_samples_with_allocation, house_sampling, load_model_and_dataset, read_samples, save_samples, train_torch_cvae
+from models.pytorch_cvae import generate_compact_samples, generate_samples_with_allocation, house_sampling, load_model_and_dataset, read_samples, save_samples, train_torch_cvae
 import pandasql
 import numpy as np
 import re
@@ -9,7 +9,6 @@ import pyspark.sql.functions as F
 from pyspark.sql.types import FloatType,LongType
 import time
 import torch
-from keras.utils.np_utils import to_categorical
 import logging
 # pd.set_option('display.max_rows', None)
 pd.set_option('display.max_columns', None)
@@ -31,7 +30,9 @@ def lowercase(query_table):
     query_table.group_cols=[t.lower() for t in query_table.group_cols]
     query_table.config_file=query_table.config_file.lower()
 
-def query_multi_sampling(query,results,training_times):
+def query_multi_sampling(query,results,training_times,execution_context=None,replicate_id=0):
+    if execution_context is not None:
+        execution_context.pin_replicate(replicate_id)
     result,training_time = query_sampling(query)
     results.append(result)
     training_times.append(training_time)
@@ -358,29 +359,8 @@ def generate_model_samples(model, dataset, query_table, train_config):
 def generate_model_samples_with_allocation(dataset, model, sample_allocation,
                                      train_config):
     start_time = time.perf_counter()
-    batch_size = train_config["batch_size"]
-    latent_dim = train_config["latent_dim"]
-    categorical_encoding = train_config["categorical_encoding"]
-    z_decoded = []
-    label_value_mapping = dataset.label_value_mapping
-    label_size = len(label_value_mapping)
-    threads=[]
-
-    for label_value_idx, label_value in label_value_mapping.items():
-        if label_value in sample_allocation:
-            sample_count = int(sample_allocation[label_value])
-            if categorical_encoding == 'binary':
-                mapping = dataset.label_mapping_out
-                label = [mapping.loc[label_value_idx].values]
-                label = torch.from_numpy(np.repeat(label, batch_size, axis=0)).to(model.device)
-                # label = np.tile(label, (sample_count, 1))
-            else:
-                label = np.ones((batch_size,)) * label_value_idx
-                label = torch.from_numpy(to_categorical(label, label_size)).to(model.device)
-            generate_group_samples(sample_count, label, latent_dim, batch_size, model, z_decoded)
-
-    z_decoded = np.concatenate(z_decoded, axis=0)
-    samples_df = dataset.decode_samples(z_decoded)
+    codes, values = generate_compact_samples(dataset, model, sample_allocation, train_config)
+    samples_df = dataset.decode_compact_samples(codes, values)
     # samples_df['{}_rate'.format(dataset.name)] = samples_df[dataset.label_column_name].map(sample_rates)
     end_time = time.perf_counter()
     logger.info('sampling time:{}'.format(end_time - start_time))
@@ -1,4 +1,5 @@
 import torch
+import hashlib
 import os.path
 import time
 import logging
@@ -87,3 +88,45 @@ def load_torch_model(param, model,postfix=''):
         return model
 
     return None
+
+
+def get_weights_digest(model):
+    # digest of the model weights, ties an exported decoder to the weights it was traced from
+    digest = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def save_traced_decoder(traced_decoder, param, weights_digest, postfix=''):
+    model_name = get_model_name(param)
+    model_name += postfix
+    torch.jit.save(traced_decoder, "./saved_models/{}_decoder.pt".format(model_name),
+                   _extra_files={'weights_digest': weights_digest})
+    logger.info("save traced decoder successfully")
+
+
+def load_traced_decoder(param, weights_digest, postfix=''):
+    """
+    weights_digest: get_weights_digest of the loaded model
+    return: the traced decoder, or None when there is none or it was traced from other weights
+    """
+    model_name = get_model_name(param)
+    model_name += postfix
+    path = "./saved_models/{}_decoder.pt".format(model_name)
+    if os.path.isfile(path):
+        gpu_num = param['gpu_num']
+        device_name = "cuda:{}".format(gpu_num) if torch.cuda.is_available() else "cpu"
+        extra_files = {'weights_digest': ''}
+        traced_decoder = torch.jit.load(path, map_location=device_name, _extra_files=extra_files)
+        saved_digest = extra_files['weights_digest']
+        if isinstance(saved_digest, bytes):
+            saved_digest = saved_digest.decode()
+        if saved_digest != weights_digest:
+            # the model was trained again after the export, or the decoder predates the digest
+            logger.warning("traced decoder {} does not match the model weights, ignored".format(path))
+            return None
+        logger.info("load traced decoder:{}".format(path))
+        return traced_decoder
+    return None
@@ -0,0 +1,81 @@
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+from utils.sample_writer import flush_sample_writer, reset_sample_writer
+
+logger = logging.getLogger(__name__)
+
+# function, arguments, execution context and seed of the running replicates, inherited by the forked workers
+replicate_task = None
+
+
+def spark_session_active():
+    # a launched py4j gateway (and its sockets and threads) would be copied into every forked worker
+    pyspark = sys.modules.get('pyspark')
+    if pyspark is None:
+        return False
+    return pyspark.SparkContext._gateway is not None
+
+
+def process_replicates_supported(model_dataset_list=()):
+    # forked workers need the fork start method and cpu models, cuda does not survive a fork
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return False
+    if spark_session_active():
+        logger.info("spark is running in this process, the replicates run in threads")
+        return False
+    return all(dataset is None or dataset.device.type == 'cpu' for _, dataset in model_dataset_list)
+
+
+def share_model_dataset(model, dataset):
+    # weights, label cache and label bias go to shared memory once, before the workers are forked
+    # the numpy encoder parameters of the light dataset are only read, so the workers share their pages
+    model.share_memory()
+    dataset.label_cache.share_memory_()
+    model.get_label_bias(dataset.label_cache).share_memory_()
+    dataset.get_decode_plan(dataset.device)
+
+
+def init_replicate_worker():
+    # the background writer thread of the parent is not forked with it
+    reset_sample_writer()
+
+
+def run_replicate(replicate_id):
+    func, args, execution_context, seed = replicate_task
+    start_time = time.perf_counter()
+    # the forked workers start from the same random state
+    torch.manual_seed(seed + replicate_id)
+    np.random.seed((seed + replicate_id) % 2 ** 32)
+    if execution_context is not None:
+        execution_context.set_threads(execution_context.replicate_threads())
+        execution_context.pin_replicate(replicate_id)
+    result = func(*args)
+    flush_sample_writer()
+    logger.info('replicate No.{} in process {} time elapsed:{}'.format(replicate_id, os.getpid(),
+                                                                      time.perf_counter() - start_time))
+    return result
+
+
+def run_process_replicates(func, args, replicates, execution_context=None):
+    """
+    func: replicate function, called as func(*args) in every worker, its result has to be picklable
+    args: arguments of func, inherited by the forked workers instead of pickled
+    replicates: number of replicates, one worker process each
+    execution_context: ExecutionContext giving the threads and cores of every worker
+    return: results of the replicates
+    """
+    global replicate_task
+    replicate_task = (func, args, execution_context, int.from_bytes(os.urandom(4), 'little'))
+    try:
+        with multiprocessing.get_context('fork').Pool(replicates, initializer=init_replicate_worker) as pool:
+            results = pool.map(run_replicate, range(replicates))
+    finally:
+        replicate_task = None
+    return results
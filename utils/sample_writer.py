@@ -0,0 +1,91 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class SampleWriter:
+    """Writes generated samples to .npz files on a background thread."""
+    def __init__(self, output_dir='./output'):
+        self.output_dir = output_dir
+        self.tasks = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, samples, name):
+        """
+        samples: DataFrame to persist
+        name: file name prefix, a timestamp and a random suffix keep concurrent writes apart
+        return: path the samples will be written to
+        """
+        path = os.path.join(self.output_dir, '{}_{}_{}.npz'.format(name, time.strftime('%Y%m%d%H%M%S'),
+                                                                    uuid.uuid4().hex[:8]))
+        # the column arrays are captured now, later column assignments on samples do not leak into the file
+        columns = {col: samples[col].values for col in samples.columns}
+        self.tasks.put((path, columns))
+        return path
+
+    def run(self):
+        while True:
+            path, columns = self.tasks.get()
+            try:
+                start_time = time.perf_counter()
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # object columns are stored as strings so the file loads without pickle
+                arrays = {col: values.astype(str) if values.dtype == object else values
+                          for col, values in columns.items()}
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'wb') as file:
+                    np.savez(file, **arrays)
+                os.replace(tmp_path, path)
+                logger.info('write samples to {} time elapsed:{}'.format(path, time.perf_counter() - start_time))
+            except Exception as e:
+                logger.error('write samples to {} failed: {}'.format(path, e))
+            finally:
+                self.tasks.task_done()
+
+    def flush(self):
+        self.tasks.join()
+
+
+sample_writer = None
+sample_writer_lock = threading.Lock()
+
+
+def get_sample_writer():
+    global sample_writer
+    with sample_writer_lock:
+        if sample_writer is None:
+            sample_writer = SampleWriter()
+            # pending samples are still written when the query finishes before the writer
+            atexit.register(sample_writer.flush)
+        return sample_writer
+
+
+def flush_sample_writer():
+    if sample_writer is not None:
+        sample_writer.flush()
+
+
+def reset_sample_writer():
+    # after a fork the writer thread is gone, the next spool starts a new one
+    global sample_writer, sample_writer_lock
+    sample_writer = None
+    sample_writer_lock = threading.Lock()
+
+
+def spool_samples(samples, name):
+    return get_sample_writer().submit(samples, name)
+
+
+def read_spooled_samples(path):
+    with np.load(path) as data:
+        return pd.DataFrame({col: data[col] for col in data.files})
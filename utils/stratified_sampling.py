@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+# row samples that keep every stratum (e.g. label group) represented, used to reduce training and fit data
+
+
+def stratified_sample_index(n, sample_size, strata=None):
+    """
+    n: number of rows
+    sample_size: rows to keep
+    strata: stratum of every row, the strata keep their share of the rows and at least one row each
+    return: sorted positions of the kept rows
+    """
+    if sample_size >= n:
+        return np.arange(n)
+    if strata is None:
+        return np.sort(np.random.choice(n, sample_size, replace=False))
+    # missing strata are a stratum of their own
+    stratum_codes = pd.factorize(strata)[0] + 1
+    stratum_counts = np.bincount(stratum_codes)
+    return stratified_quota_index(stratum_codes, stratified_quotas(stratum_counts, sample_size))
+
+
+def stratified_quotas(stratum_counts, sample_size):
+    """
+    stratum_counts: rows of every stratum
+    sample_size: rows to keep
+    return: rows to keep of every stratum, its share of sample_size and at least one row
+    """
+    quotas = np.round(stratum_counts * sample_size / stratum_counts.sum())
+    return np.minimum(np.maximum(quotas, 1), stratum_counts).astype(np.int64)
+
+
+def senate_allocation(stratum_counts, total_sample):
+    """
+    stratum_counts: rows of every stratum
+    total_sample: rows to keep
+    return: rows to keep of every stratum, the strata smaller than an even share of total_sample are kept whole,
+        the larger ones share the remaining rows in proportion to their size
+    """
+    k = total_sample / (stratum_counts > 0).sum()
+    small_strata = stratum_counts <= k
+    sample_left = total_sample - stratum_counts[small_strata].sum()
+    big_stratum_rows = stratum_counts[~small_strata].sum()
+    big_allocation = np.maximum(np.floor(sample_left * stratum_counts / max(big_stratum_rows, 1)), 1)
+    allocation = np.where(small_strata, stratum_counts, big_allocation)
+    return np.minimum(allocation, stratum_counts).astype(np.int64)
+
+
+def stratified_quota_index(stratum_codes, quotas):
+    """
+    stratum_codes: non negative stratum of every row
+    quotas: rows to keep of every stratum
+    return: sorted positions of the kept rows, uniformly drawn inside every stratum
+    """
+    n = len(stratum_codes)
+    stratum_counts = np.bincount(stratum_codes, minlength=len(quotas))
+    # a random rank inside its stratum for every row, the rows ranked below the quota of their stratum are kept
+    order = np.lexsort((np.random.random_sample(n), stratum_codes))
+    stratum_starts = np.cumsum(stratum_counts) - stratum_counts
+    ranks = np.empty(n, dtype=np.int64)
+    ranks[order] = np.arange(n) - np.repeat(stratum_starts, stratum_counts)
+    return np.flatnonzero(ranks < quotas[stratum_codes])